@@ -0,0 +1,344 @@
+"""
+Benchmarks of the analysis and plotting stages of `report` and of a full `main` run, on synthetic
+EEG recordings. Every stage is timed and its peak memory measured with `tracemalloc`. Results are
+appended as JSON lines, tagged with the version of `report`, so runs of different versions can
+be compared with `--compare`.
+
+    python benchmark.py --channels 19 64 --minutes 1 10
+    python benchmark.py --compare benchmarks/results.jsonl --against old_results.jsonl
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy.signal
+import report as rp
+import render
+import main as app
+
+
+# Amplitude (uV) of the oscillation added at the center of every band
+DEFAULT_CONTENT = {"delta": 10,
+                   "theta": 6,
+                   "alpha1": 15,
+                   "alpha2": 8,
+                   "beta1": 4,
+                   "beta2": 3,
+                   "gamma": 1}
+
+# Filter approximating 1/f (pink) noise from white noise
+_PINK_B = [0.049922035, -0.095993537, 0.050612699, -0.004408786]
+_PINK_A = [1, -2.494956002, 2.017265875, -0.522189400]
+
+
+def synthetic_setup(n_channels):
+    """
+    Return a channel setup with `n_channels` electrodes, in the format of `main`.
+    Up to 19 channels use the default 10-20 setup, larger montages are spread over the head
+    on a sunflower spiral and named `Ch1`, `Ch2`...
+    """
+    if n_channels <= 19:
+        setup = pd.DataFrame(rp.read_chsetup()[:n_channels], columns=["x", "y", "name"])
+        setup[["x", "y"]] = setup[["x", "y"]].astype(float)
+        return setup
+    i = np.arange(n_channels) + .5
+    r = np.sqrt(i / n_channels)
+    theta = np.pi * (1 + 5**.5) * i
+    return pd.DataFrame({"x": .5 + .5 * r * np.cos(theta),
+                         "y": .5 + .5 * r * np.sin(theta),
+                         "name": ["Ch" + str(j + 1) for j in range(n_channels)]})
+
+
+def eeg_blocks(n_channels, duration, fs=500, content=None, bands=None, noise=10, seed=0,
+               block_size=60000):
+    """
+    Generate a synthetic EEG recording in blocks of samples.
+    Every channel is pink noise plus one oscillation per band, with a random phase and a gain
+    per channel. A third of every oscillation is shared by all the channels, so connectivity
+    measures are not trivially zero.
+    :param n_channels: number of channels
+    :param duration: duration of the recording in seconds
+    :param fs: sampling frequency
+    :param content: amplitude in uV of the oscillation at the center of each band, by band name.
+                    Default `DEFAULT_CONTENT`
+    :param bands: bands dataframe, see `report.create_bands`. Default `main.default_bands()`
+    :param noise: standard deviation of the pink noise in uV
+    :param seed: seed of the random generator
+    :param block_size: samples per block
+    :returns: generator of `(samples, n_channels)` arrays
+    """
+    content = DEFAULT_CONTENT if content is None else content
+    bands = app.default_bands() if bands is None else bands
+    rng = np.random.default_rng(seed)
+    freqs = []
+    amps = []
+    for i, band in bands.iterrows():
+        if band["name"] in content:
+            freqs.append((band["low"] + band["high"]) / 2.0)
+            amps.append(content[band["name"]])
+    freqs = np.array(freqs)
+    amps = np.array(amps)
+    gains = rng.uniform(.5, 1.5, (len(freqs), n_channels)) * amps[:, None]
+    phases = rng.uniform(0, 2 * np.pi, (len(freqs), n_channels))
+    shared = rng.uniform(0, 2 * np.pi, len(freqs))
+    zi = np.zeros((len(_PINK_A) - 1, n_channels))
+    # scale of the pink filter output for unit white noise
+    scale = noise / np.sqrt(np.sum(scipy.signal.lfilter(_PINK_B, _PINK_A, np.r_[1, np.zeros(9999)])**2))
+    n_samples = int(duration * fs)
+    for start in range(0, n_samples, block_size):
+        t = np.arange(start, min(start + block_size, n_samples)) / float(fs)
+        white = rng.standard_normal((len(t), n_channels))
+        block, zi = scipy.signal.lfilter(_PINK_B, _PINK_A, white, axis=0, zi=zi)
+        block *= scale
+        for k, f in enumerate(freqs):
+            wt = 2 * np.pi * f * t[:, None]
+            block += gains[k] * (2 * np.sin(wt + phases[k]) + np.sin(wt + shared[k])) / 3
+        yield block
+
+
+def synthetic_eeg(n_channels, duration, fs=500, **kwargs):
+    """
+    Return a synthetic EEG recording as a dataframe with the channel names of `synthetic_setup`.
+    See `eeg_blocks` for the options.
+    """
+    data = np.concatenate(list(eeg_blocks(n_channels, duration, fs, **kwargs)))
+    return pd.DataFrame(data, columns=synthetic_setup(n_channels)["name"])
+
+
+def write_eeg(path, n_channels, duration, fs=500, suffix="-A1A2", **kwargs):
+    """
+    Write a synthetic EEG recording as a tab separated file, block by block, with the header
+    convention of `report.read_sig`: one column per channel named `<channel><suffix>`.
+    See `eeg_blocks` for the options.
+    """
+    names = [name + suffix for name in synthetic_setup(n_channels)["name"]]
+    with open(path, "w") as fh:
+        fh.write("\t".join(names) + "\n")
+        for block in eeg_blocks(n_channels, duration, fs, **kwargs):
+            np.savetxt(fh, block, fmt="%.4f", delimiter="\t")
+    return path
+
+
+def write_setup(path, setup):
+    """
+    Write a channel setup as a tab separated file readable by `report.read_chsetup`
+    """
+    setup[["x", "y", "name"]].to_csv(path, sep="\t", index=False)
+    return path
+
+
+def measure(func, args=(), memory=True):
+    """
+    Call `func(*args)` and return its result, the elapsed seconds and the peak of memory allocated
+    during the call in bytes.
+    :param memory: trace the memory allocations, which slows down Python code. If False the peak is None
+    """
+    if not memory:
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start, None
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _figures(func, tasks):
+    return [render.render(func, args) for args in tasks]
+
+
+def run_stages(path, setup, bands, fs, memory=True):
+    """
+    Run every stage of `report` on the recording at `path` and measure it, see `measure`.
+    :returns: list of `(stage, seconds, peak bytes)`
+    """
+    results = []
+
+    def stage(name, func, *args):
+        result, elapsed, peak = measure(func, args, memory)
+        results.append((name, elapsed, peak))
+        return result
+
+    n_channels = len(setup)
+    pos = {row["name"]: (row["x"], row["y"]) for i, row in setup.iterrows()}
+    sig = stage("read_sig", rp.read_sig, path, n_channels)
+    psd_df, phase_df = stage("sig_to_frequency", rp.sig_to_frequency, sig, fs)
+    band_index = rp.BandIndex(bands, psd_df.index)
+    peaks_df = stage("band_peaks", rp.band_peaks, psd_df, bands, band_index)
+    abs_df = stage("pot_abs", rp.pot_abs, psd_df, bands, band_index)
+    rel_df = stage("pot_rel", rp.pot_rel, abs_df)
+    cor_df = stage("corr", sig.corr)
+    coh_df = stage("coh", rp.coh, sig, bands, fs)
+    pdif_df = stage("phase_dif", rp.phase_dif, phase_df, bands, band_index)
+    stage("headmap", _figures, rp.headmap, [(abs_df.iloc[[i]], setup) for i in range(len(abs_df))])
+    stage("cor_headnet", _figures, rp.cor_headnet, [(cor_df, pos)])
+    stage("coh_headnet", _figures, rp.coh_headnet, [(coh_df.iloc[[i]], pos) for i in range(len(coh_df))])
+    stage("phs_headnet", _figures, rp.phs_headnet, [(pdif_df.iloc[[i]], pos) for i in range(len(pdif_df))])
+    return results
+
+
+def run_main(path, setup_path, fs, output, template=None):
+    """
+    Run `main.main` on the recording at `path`, without result cache or sidecar
+    """
+    argv = ["main.py", "--input", path, "--output", output, "--setup", setup_path,
+            "--frequency", str(fs), "--no-cache", "--no-sidecar"]
+    if template:
+        argv += ["--template", template]
+    old_argv = sys.argv
+    sys.argv = argv
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            app.main()
+    finally:
+        sys.argv = old_argv
+
+
+def _revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(channels, minutes, fs, data_folder, output, full=True, template=None, memory=True):
+    """
+    Run the benchmarks over the grid of channel counts and durations and append the results
+    to `<output>/results.jsonl`. Synthetic recordings are written once to `data_folder` and
+    reused by later runs. See `measure` for `memory`.
+    :returns: list of result records
+    """
+    for folder in (data_folder, output):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    bands = app.default_bands()
+    info = {"version": rp.__version__,
+            "revision": _revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "fs": fs}
+    records = []
+    for n_channels in channels:
+        setup = synthetic_setup(n_channels)
+        setup_path = write_setup(os.path.join(data_folder, "setup_{}ch.tsv".format(n_channels)), setup)
+        for duration in minutes:
+            name = "eeg_{}ch_{:g}min_{}hz".format(n_channels, duration, fs)
+            path = os.path.join(data_folder, name + ".txt")
+            if not os.path.exists(path):
+                print("INFO: Writing synthetic recording " + path)
+                write_eeg(path, n_channels, duration * 60, fs)
+            stages = run_stages(path, setup, bands, fs, memory)
+            if full:
+                report_folder = os.path.join(output, "reports")
+                stages.append(("main",) + measure(run_main, (path, setup_path, fs, report_folder, template),
+                                                  memory)[1:])
+            for stage, elapsed, peak in stages:
+                record = dict(info, channels=n_channels, minutes=duration, stage=stage,
+                              seconds=elapsed, peak_mb=peak / 1024.0**2 if memory else None)
+                print("{channels:>4} ch {minutes:>4g} min  {stage:<17} {seconds:9.3f} s {peak:>10} MB".format(
+                    peak="-" if peak is None else "{:.1f}".format(record["peak_mb"]), **record))
+                records.append(record)
+    with open(os.path.join(output, "results.jsonl"), "a") as fh:
+        for record in records:
+            fh.write(json.dumps(record) + "\n")
+    return records
+
+
+def load(path):
+    """
+    Read benchmark results, keeping the latest record of every (channels, minutes, stage)
+    """
+    results = {}
+    with open(path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            results[(record["channels"], record["minutes"], record["stage"])] = record
+    return results
+
+
+def compare(path, baseline):
+    """
+    Print the time and memory of the results in `path` relative to `baseline`
+    """
+    new = load(path)
+    old = load(baseline)
+    print("{:>4} {:>6} {:<17} {:>10} {:>10} {:>8} {:>8}".format(
+        "ch", "min", "stage", "seconds", "baseline", "time", "memory"))
+    for key in sorted(set(new) & set(old)):
+        n, o = new[key], old[key]
+        memory = "-"
+        if n["peak_mb"] is not None and o["peak_mb"] is not None:
+            memory = "{:.2f}x".format(n["peak_mb"] / max(o["peak_mb"], 1e-9))
+        print("{:>4} {:>6g} {:<17} {:>10.3f} {:>10.3f} {:>7.2f}x {:>8}".format(
+            key[0], key[1], key[2], n["seconds"], o["seconds"],
+            n["seconds"] / max(o["seconds"], 1e-9), memory))
+
+
+def create_parser(dir_path=os.path.dirname(os.path.realpath(__file__))):
+    parser = argparse.ArgumentParser(prog="Reportes benchmark",
+                                     description="Benchmarks of the report stages on synthetic EEG.",
+                                     add_help=True)
+    parser.add_argument("--channels", "-c",
+                        help="Channel counts of the synthetic recordings",
+                        type=int,
+                        nargs="+",
+                        default=[19, 64, 128])
+    parser.add_argument("--minutes", "-m",
+                        help="Durations of the synthetic recordings in minutes",
+                        type=float,
+                        nargs="+",
+                        default=[1, 10, 60])
+    parser.add_argument("--frequency", "-f",
+                        help="Sampling frequency of the synthetic recordings",
+                        dest="fs",
+                        type=int,
+                        default=500)
+    parser.add_argument("--data",
+                        help="Folder of the synthetic recordings",
+                        default=os.path.join(dir_path, "benchmarks", "data"))
+    parser.add_argument("--output", "-o",
+                        help="Folder of the benchmark results",
+                        default=os.path.join(dir_path, "benchmarks"))
+    parser.add_argument("--template", "-t",
+                        help="Markdown template used by the full run")
+    parser.add_argument("--stages-only",
+                        help="Do not benchmark the full main run",
+                        dest="full",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--no-memory",
+                        help="Only time the stages, without tracing memory allocations",
+                        dest="memory",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--compare",
+                        help="Results file to compare instead of running the benchmarks")
+    parser.add_argument("--against",
+                        help="Baseline results file of --compare")
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    if args.compare:
+        if not args.against:
+            raise ValueError("ERROR: --compare needs a baseline results file, see --against")
+        compare(args.compare, args.against)
+    else:
+        benchmark(args.channels, args.minutes, args.fs, args.data, args.output, args.full, args.template,
+                  args.memory)
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import report as rp
+
+# subfolder with the `.npy` sidecars of the signals, see `report.read_sig`
+SIGNALS = "signals"
+
+
+class ResultCache(object):
+    """
+    Persistent cache of analysis results, addressed by the contents of the input file and the
+    analysis parameters. Entries are `.npz` stores (see `report.save_results`). They share
+    `max_size` with the signal sidecars of the `SIGNALS` subfolder, and the least recently used
+    files of both are evicted once the folder grows over it.
+    :param folder: folder holding the cache entries
+    :param max_size: maximum size of the cache in bytes
+    """
+
+    def __init__(self, folder, max_size=2 * 1024**3):
+        self.folder = folder
+        self.signals = os.path.join(folder, SIGNALS)
+        self.max_size = max_size
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def key(self, path, params):
+        """
+        Return the cache key of a recording analyzed with the given parameters
+        :param path: path of the input file
+        :param params: JSON serializable dictionary with everything the results depend on
+        """
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        h.update(rp.__version__.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npz")
+
+    def load(self, key):
+        """
+        Return the stored tables for `key`, or None if there is no entry
+        """
+        path = self._path(key)
+        try:
+            tables = rp.load_results(path)
+            os.utime(path)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return tables
+
+    def store(self, key, tables):
+        """
+        Store the tables for `key` and evict old entries if needed
+        """
+        path = self._path(key)
+        temp = path + "." + str(os.getpid()) + ".npz"
+        rp.save_results(temp, tables)
+        os.replace(temp, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries and sidecars until the cache fits in `max_size`
+        """
+        # only final `<key>.npz` entries, not the `<key>.npz.<pid>.npz` files being written
+        paths = [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                 if name.endswith(".npz") and name.count(".") == 1]
+        if os.path.isdir(self.signals):
+            # sidecars being written start with a dot
+            paths += [os.path.join(self.signals, name) for name in os.listdir(self.signals)
+                      if name.endswith(".npy") and not name.startswith(".")]
+        entries = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
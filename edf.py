@@ -0,0 +1,176 @@
+"""
+Reader of EDF, EDF+ and BDF recordings.
+The data records are memory mapped, so only the samples of the requested channels and time
+range are read and decoded, and the digital values are scaled to microvolts with one vectorized
+operation per channel.
+"""
+import os
+import numpy as np
+
+EXTENSIONS = (".edf", ".bdf")
+
+# microvolts per physical unit
+UNITS = {"uv": 1.0, "\xb5v": 1.0, "mv": 1e3, "v": 1e6, "nv": 1e-3}
+
+
+def is_edf(path):
+    return os.path.splitext(path)[1].lower() in EXTENSIONS
+
+
+def channel_name(label):
+    """
+    Return the electrode of an EDF signal label, e.g. "Fp1" for "EEG Fp1-A1A2"
+    """
+    name = label.strip()
+    if name.upper().startswith("EEG "):
+        name = name[4:].strip()
+    return name.split("-")[0].strip()
+
+
+class EDFReader(object):
+    """
+    Memory mapped EDF, EDF+ or BDF recording.
+    Annotation signals of EDF+ and BDF+ are not listed as channels. Discontinuous EDF+ records
+    are read one after the other.
+    :param path: path of the recording
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "rb") as fh:
+                fixed = fh.read(256)
+                n_signals = int(fixed[252:256])
+                fields = fh.read(256 * n_signals)
+        except (IOError, OSError, ValueError):
+            raise IOError("ERROR: could not read the EDF header of " + path)
+        if len(fixed) < 256 or len(fields) < 256 * n_signals:
+            raise IOError("ERROR: truncated EDF header in " + path)
+        self.bdf = fixed[0:1] == b"\xff"
+        self.width = 3 if self.bdf else 2
+        self.header_bytes = int(fixed[184:192])
+        self.record_duration = float(fixed[244:252])
+        self.reserved = fixed[192:236].decode("latin-1").strip()
+
+        def field(start, size):
+            # every signal field holds `n_signals` consecutive values of `size` characters
+            offset = start * n_signals
+            return [fields[offset + i * size:offset + (i + 1) * size].decode("latin-1").strip()
+                    for i in range(n_signals)]
+
+        labels = field(0, 16)
+        units = field(16 + 80, 8)
+        physical_min = np.array(field(16 + 80 + 8, 8), dtype=np.float64)
+        physical_max = np.array(field(16 + 80 + 16, 8), dtype=np.float64)
+        digital_min = np.array(field(16 + 80 + 24, 8), dtype=np.float64)
+        digital_max = np.array(field(16 + 80 + 32, 8), dtype=np.float64)
+        samples = np.array(field(16 + 80 + 40 + 80, 8), dtype=np.int64)
+
+        # byte offset of every signal inside a data record
+        offsets = np.concatenate(([0], np.cumsum(samples * self.width)[:-1]))
+        self.record_bytes = int(samples.sum() * self.width)
+        n_records = int(fixed[236:244])
+        available = (os.path.getsize(path) - self.header_bytes) // self.record_bytes
+        self.n_records = available if n_records < 0 else min(n_records, available)
+
+        signals = [i for i in range(n_signals) if labels[i] not in ("EDF Annotations", "BDF Annotations")]
+        self.labels = [labels[i] for i in signals]
+        self.units = [units[i] for i in signals]
+        self.samples_per_record = samples[signals]
+        self.offsets = offsets[signals]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = (physical_max - physical_min) / (digital_max - digital_min)
+        scale = np.array([UNITS.get(u.lower(), 1.0) for u in units])
+        self.gain = (gain * scale)[signals]
+        self.offset = ((physical_min - digital_min * gain) * scale)[signals]
+        self.fs = self.samples_per_record / self.record_duration
+
+        self._records = np.memmap(path, dtype=np.uint8, mode="r", offset=self.header_bytes,
+                                  shape=(self.n_records, self.record_bytes))
+
+    @property
+    def channels(self):
+        """
+        Electrode names of the channels, see `channel_name`
+        """
+        return [channel_name(label) for label in self.labels]
+
+    def select(self, names=None, n_channels=None):
+        """
+        Return the indices of the channels named `names` (case insensitive, see `channel_name`),
+        or of the first `n_channels` channels
+        """
+        if names is None:
+            return list(range(len(self.labels) if n_channels is None else min(n_channels, len(self.labels))))
+        lookup = {}
+        for i, name in enumerate(self.channels):
+            lookup.setdefault(name.lower(), i)
+        missing = [str(n) for n in names if str(n).lower() not in lookup]
+        if missing:
+            raise ValueError("ERROR: channels missing in " + self.path + ": " + ", ".join(missing))
+        return [lookup[str(n).lower()] for n in names]
+
+    def frequency(self, channels):
+        """
+        Return the sampling frequency shared by `channels`
+        """
+        fs = np.unique(self.fs[channels])
+        if len(fs) != 1:
+            raise ValueError("ERROR: channels with different sampling frequencies in " + self.path)
+        return float(fs[0])
+
+    def n_samples(self, channels):
+        return int(self.n_records * self.samples_per_record[channels[0]])
+
+    def read(self, channels, start=0, stop=None, dtype=np.float64):
+        """
+        Return the samples of `channels` between `start` and `stop` in physical units (microvolts
+        for voltages) as a samples x channels array
+        :param channels: channel indices, see `select`. They must share their sampling frequency
+        :param start: first sample
+        :param stop: sample after the last one. Defaults to the end of the recording
+        :param dtype: numeric type of the samples
+        """
+        self.frequency(channels)
+        spr = int(self.samples_per_record[channels[0]])
+        total = self.n_samples(channels)
+        stop = total if stop is None else min(stop, total)
+        start = max(0, min(start, stop))
+        first, last = start // spr, -(-stop // spr)
+        skip = start - first * spr
+        out = np.empty((stop - start, len(channels)), dtype=dtype)
+        for k, c in enumerate(channels):
+            begin = int(self.offsets[c])
+            raw = self._records[first:last, begin:begin + spr * self.width]
+            if self.bdf:
+                raw = raw.reshape(-1, 3).astype(np.int32)
+                digital = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+                digital = (digital ^ 0x800000) - 0x800000        # sign of the 24 bit values
+            else:
+                digital = np.ascontiguousarray(raw).view("<i2").ravel()
+            out[:, k] = digital[skip:skip + stop - start] * self.gain[c] + self.offset[c]
+        return out
+
+    def blocks(self, channels, block_size, dtype=np.float64):
+        """
+        Yield the samples of `channels` in blocks of `block_size` samples, see `read`
+        """
+        total = self.n_samples(channels)
+        for start in range(0, total, block_size):
+            yield self.read(channels, start, start + block_size, dtype)
+
+
+def check_recording(path, names, fs=None):
+    """
+    Check that an EDF/BDF recording has the channels of the setup and return their sampling
+    frequency, which is taken from the header. A different `fs` is reported and ignored.
+    :param path: path of the recording
+    :param names: channel names of the setup
+    :param fs: expected sampling frequency
+    """
+    reader = EDFReader(path)
+    header_fs = reader.frequency(reader.select(names))
+    if fs is not None and header_fs != fs:
+        print("WARNING: " + path + " is sampled at {:g} Hz, not {:g} Hz. Using {:g} Hz.".format(
+            header_fs, fs, header_fs))
+    return int(header_fs) if header_fs == int(header_fs) else header_fs
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+
+
+# Path of the trace being written, None while instrumentation is disabled
+_trace = None
+_local = threading.local()
+
+
+def enable(path, truncate=False):
+    """
+    Record the stages of this process to the trace at `path`.
+    Every stage is appended as one JSON line holding a Chrome trace event, so several processes
+    can write to the same trace. See `chrome_trace` and `summary` to read it.
+    :param path: path of the JSON lines trace
+    :param truncate: start an empty trace instead of appending to it
+    """
+    global _trace
+    if truncate:
+        open(path, "w").close()
+    _trace = path
+
+
+def disable():
+    global _trace
+    _trace = None
+
+
+def enabled():
+    return _trace is not None
+
+
+def _peak_rss():
+    """
+    Return the peak resident memory of this process in bytes
+    """
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident memory of this process, so it measures the next stage only.
+    Only possible on Linux, elsewhere the peak is the one of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def _write(event):
+    line = (json.dumps(event) + "\n").encode("utf-8")
+    # a single append per event, so lines of concurrent processes are not interleaved
+    fd = os.open(_trace, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def stage(name, **args):
+    """
+    Context manager recording wall time, CPU time and peak resident memory of a pipeline stage.
+    Stages nest: the arguments of the enclosing stages, like the file being processed, are
+    inherited, and the self time of a stage excludes the time of the stages inside it.
+    Does nothing while instrumentation is disabled, see `enable`.
+    :param name: name of the stage
+    :param args: extra values stored with the event
+    """
+    if _trace is None:
+        yield
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    if stack:
+        parent = stack[-1]
+        parent["peak"] = max(parent["peak"], _peak_rss())
+        args = dict(parent["args"], **args)
+    current = {"args": args, "children": 0.0, "peak": 0}
+    stack.append(current)
+    _reset_peak_rss()
+    start = time.time()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stack.pop()
+        peak = max(current["peak"], _peak_rss())
+        if stack:
+            stack[-1]["children"] += wall
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        _write({"name": name,
+                "cat": "stage",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int(wall * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": dict(args,
+                             wall_s=wall,
+                             self_s=wall - current["children"],
+                             cpu_s=cpu,
+                             peak_rss_mb=peak / 1024.0**2)})
+
+
+def timed(func):
+    """
+    Decorator recording every call of `func` as a stage named after it, see `stage`
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _trace is None:
+            return func(*args, **kwargs)
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def read_trace(path):
+    """
+    Return the events of a JSON lines trace
+    """
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def chrome_trace(path, output):
+    """
+    Convert the JSON lines trace at `path` to a Chrome trace file (chrome://tracing, Perfetto)
+    """
+    with open(output, "w") as fh:
+        json.dump({"traceEvents": read_trace(path), "displayTimeUnit": "ms"}, fh)
+
+
+def summary(path, top=10):
+    """
+    Return a table of the hottest stages of a trace, by total self time over all files
+    :param path: path of the JSON lines trace
+    :param top: number of stages listed
+    """
+    stages = {}
+    for event in read_trace(path):
+        s = stages.setdefault(event["name"], {"calls": 0, "wall": 0.0, "self": 0.0, "cpu": 0.0, "peak": 0.0})
+        s["calls"] += 1
+        s["wall"] += event["args"]["wall_s"]
+        s["self"] += event["args"]["self_s"]
+        s["cpu"] += event["args"]["cpu_s"]
+        s["peak"] = max(s["peak"], event["args"]["peak_rss_mb"])
+    total = sum(s["self"] for s in stages.values()) or 1.0
+    lines = ["{:<22} {:>6} {:>10} {:>10} {:>10} {:>6} {:>12}".format(
+        "stage", "calls", "self (s)", "wall (s)", "cpu (s)", "self%", "peak RSS MB")]
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]["self"])[:top]:
+        lines.append("{:<22} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>5.1f}% {:>12.1f}".format(
+            name, s["calls"], s["self"], s["wall"], s["cpu"], 100 * s["self"] / total, s["peak"]))
+    return "\n".join(lines)
@@ -2,9 +2,17 @@ import argparse
 import report as rp
 import pandas as pd
 import numpy as np
-import pweave
+import render
+import cache
+import instrument
+import stats
+import store
+import edf
 import os
 import shutil
+import functools
+import multiprocessing
+import concurrent.futures
 
 
 def create_parser(dir_path=os.path.dirname(os.path.realpath(__file__))):
@@ -35,15 +43,412 @@ def create_parser(dir_path=os.path.dirname(os.path.realpath(__file__))):
     parser.add_argument("--output", "-o",
                         help="Folder name to save the reports",
                         default=os.path.join(dir_path, "Reports"))
+    parser.add_argument("--dtype",
+                        help="Numeric type used to read the signals",
+                        choices=["float32", "float64"],
+                        default="float64")
+    parser.add_argument("--no-sidecar",
+                        help="Do not keep parsed signals as .npy files in the signals folder of the cache",
+                        dest="sidecar",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--block-size",
+                        help="Analyze the signals in blocks of this many samples to bound memory use",
+                        dest="block_size",
+                        type=int,
+                        default=None)
+    parser.add_argument("--estimator", "-e",
+                        help="Spectral estimator: a single full length FFT, or Welch or multitaper "
+                             "estimates averaged over segments",
+                        choices=rp.ESTIMATORS,
+                        default="fft")
+    parser.add_argument("--segment",
+                        help="Length in seconds of the segments of the welch and multitaper estimators",
+                        type=float,
+                        default=2.0)
+    parser.add_argument("--overlap",
+                        help="Fraction of a segment overlapping the next one",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--bandwidth",
+                        help="Half bandwidth in Hz of the multitaper estimator",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--time-resolved",
+                        help="Also compute band power, relative power and peak frequency over sliding windows",
+                        dest="time_resolved",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--time-window",
+                        help="Length in seconds of the windows of --time-resolved",
+                        dest="time_window",
+                        type=float,
+                        default=2.0)
+    parser.add_argument("--time-overlap",
+                        help="Fraction of a window of --time-resolved overlapping the next one",
+                        dest="time_overlap",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--synchrony",
+                        help="Also compute phase locking value, weighted phase lag index and amplitude "
+                             "envelope correlation of every band",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--spectrum-max",
+                        help="Highest frequency of the stored power spectrum. Default: top of the highest band",
+                        dest="spectrum_max",
+                        type=float,
+                        default=None)
+    parser.add_argument("--spectrum-resolution",
+                        help="Frequency step in Hz of the stored power spectrum. "
+                             "Default: that of the recording, or 0.25 Hz when analyzing a folder",
+                        dest="spectrum_resolution",
+                        type=float,
+                        default=None)
+    parser.add_argument("--full-spectrum",
+                        help="Store the whole power spectrum in double precision",
+                        dest="compact_spectrum",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--no-store",
+                        help="Do not keep the result tables of the run in the <OUTPUT>/results parquet store",
+                        dest="store",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--csv",
+                        help="Also export the result tables as csv files",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--cache-dir",
+                        help="Folder of the result cache",
+                        dest="cache_dir",
+                        default=os.path.join(dir_path, "cache"))
+    parser.add_argument("--cache-size",
+                        help="Maximum size of the result cache in MB, signal sidecars included",
+                        dest="cache_size",
+                        type=int,
+                        default=2048)
+    parser.add_argument("--no-cache",
+                        help="Recompute every file instead of using the result cache",
+                        dest="cache",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--render-jobs",
+                        help="Number of processes rendering the figures of each report. 0 uses all the cores",
+                        dest="render_jobs",
+                        type=int,
+                        default=1)
+    parser.add_argument("--max-figures",
+                        help="Maximum number of figures being rendered or held in memory at once",
+                        dest="max_figures",
+                        type=int,
+                        default=4)
+    parser.add_argument("--image-format",
+                        help="Image format of the report figures",
+                        dest="image_format",
+                        choices=sorted(render.FORMATS),
+                        default="png")
+    parser.add_argument("--dpi",
+                        help="Resolution of the report figures, also the maximum of every template chunk",
+                        type=int,
+                        default=100)
+    parser.add_argument("--external-assets",
+                        help="Write the report figures to <OUTPUT>/assets instead of embedding them",
+                        dest="embed",
+                        action="store_false",
+                        default=True)
+    parser.add_argument("--report-budget",
+                        help="Maximum MB of figures embedded in each report, the rest go to <OUTPUT>/assets",
+                        dest="report_budget",
+                        type=float,
+                        default=None)
+    parser.add_argument("--groups",
+                        help="Tab separated file with the columns file, group and (for paired designs) subject. "
+                             "Compares the groups with permutation tests in the group report",
+                        default=None)
+    parser.add_argument("--design",
+                        help="Independent groups, or two conditions of the same subjects",
+                        choices=stats.DESIGNS,
+                        default="independent")
+    parser.add_argument("--permutations",
+                        help="Number of permutations of the group comparison",
+                        type=int,
+                        default=5000)
+    parser.add_argument("--correction",
+                        help="Multiple comparison correction: maximum statistic or cluster mass",
+                        choices=stats.CORRECTIONS,
+                        default="max")
+    parser.add_argument("--cluster-alpha",
+                        help="Parametric p-value of the threshold forming the clusters",
+                        dest="cluster_alpha",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--alpha",
+                        help="Significance level of the maps of the group comparison",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--seed",
+                        help="Seed of the permutations",
+                        type=int,
+                        default=0)
+    parser.add_argument("--profile",
+                        help="Record time and memory of every stage to <OUTPUT>/profile.jsonl and profile.json "
+                             "(Chrome trace), and print the hottest stages",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--jobs", "-j",
+                        help="Number of files processed in parallel. 0 uses all the cores",
+                        type=int,
+                        default=1)
     return parser
 
 
+def default_bands():
+    """
+    Return the frequency bands analyzed when no band file is given
+    """
+    band_names = ["delta",
+                  "theta",
+                  "alpha1",
+                  "alpha2",
+                  "beta1",
+                  "beta2",
+                  "gamma"]
+    band_lows  = [1, 4, 8, 11, 14, 20, 31]
+    band_highs = [4, 8, 11, 14, 20, 31, 50]
+    return rp.create_bands(band_names, band_lows, band_highs)
+
+
+def report_names(files):
+    """
+    Return the files to analyze and the report name of each one, the file name without extension.
+    A text export next to an EDF/BDF recording with the same name is skipped, and other files
+    sharing a name keep their extension, so reports, tables and cache entries do not overwrite
+    each other.
+    """
+    def stem(f):
+        return os.path.splitext(os.path.basename(f))[0]
+
+    recordings = set(stem(f) for f in files if edf.is_edf(f))
+    selected = []
+    for f in files:
+        if stem(f) in recordings and not edf.is_edf(f):
+            print("INFO: Skipping " + f + ", the EDF/BDF recording with the same name is analyzed")
+        else:
+            selected.append(f)
+    stems = [stem(f) for f in selected]
+    names = [os.path.basename(f) if stems.count(s) > 1 else s for f, s in zip(selected, stems)]
+    return selected, names
+
+
+TABLES = ["psd_df", "peaks_df", "abs_df", "rel_df", "cor_df", "coh_df", "pdif_df"]
+SYNCHRONY_TABLES = ["plv_df", "wpli_df", "amp_cor_df"]
+# frequency step in Hz of the stored spectra of a folder, so recordings of any length can be averaged
+GROUP_RESOLUTION = 0.25
+
+
+def analyze(sig, bands, fs, estimator="fft", estimator_options=None, time_options=None, synchrony=False):
+    """
+    Run every analysis stage on a signal and return the result tables by name.
+    With the `fft` estimator phase differences come from the full length transform, with the
+    segment averaged ones (see `report.estimate_psd`) from the cross spectra. With `welch` the
+    power spectrum is the diagonal of the cross spectra, which use its segments.
+    :param estimator: spectral estimator, one of `report.ESTIMATORS`
+    :param estimator_options: keyword arguments of the estimator, the `fft` estimator ignores them
+    :param time_options: if given, also compute time resolved band power with these keyword
+                         arguments, see `report.band_power_time`
+    :param synchrony: also compute the phase synchrony tables, see `report.phase_synchrony`
+    """
+    if estimator == "welch":
+        freqs, S = rp.welch_cross_spectra(sig, fs=fs, **(estimator_options or {}))
+        psd_df = pd.DataFrame(np.real(np.diagonal(S, axis1=1, axis2=2)), index=freqs, columns=sig.columns)
+    else:
+        freqs, S = rp.cross_spectra(sig.values, fs=fs)
+        if estimator == "fft":
+            psd_df, phase_df = rp.sig_to_frequency(sig, fs=fs)
+        else:
+            psd_df = rp.estimate_psd(sig, fs, estimator, **(estimator_options or {}))
+    band_index = rp.BandIndex(bands, psd_df.index)
+    abs_df = rp.pot_abs(psd_df, bands, band_index)
+    if estimator == "fft":
+        pdif_df = rp.phase_dif(phase_df, bands, band_index)
+    else:
+        pdif_df = rp.csd_phase_dif(freqs, S, bands, sig.columns)
+    tables = {"psd_df": psd_df,
+              "peaks_df": rp.band_peaks(psd_df, bands, band_index),
+              "abs_df": abs_df,
+              "rel_df": rp.pot_rel(abs_df),
+              "cor_df": sig.corr(),
+              "coh_df": rp.csd_coh(freqs, S, bands, sig.columns),
+              "pdif_df": pdif_df}
+    if time_options is not None:
+        tables.update(rp.band_power_time(sig, bands, fs, **time_options))
+    if synchrony:
+        tables.update(rp.phase_synchrony(sig, bands, fs))
+    return tables
+
+
+def analyze_blocks(columns, blocks, bands, fs, estimator_options=None, time_options=None, synchrony=False):
+    """
+    Run every analysis stage on a signal read in blocks and return the result tables by name.
+    Memory is bounded by the block size: spectra are Welch estimates accumulated block by block,
+    and phase differences come from the cross spectra.
+    :param estimator_options: `nperseg` (seconds, default 2) and `overlap` (fraction) of the Welch segments
+    :param time_options: if given, also compute time resolved band power, see `analyze`
+    :param synchrony: also compute the phase synchrony tables, filtering every block with a few
+                      seconds of its neighbours, see `report.PhaseSynchrony`
+    """
+    options = estimator_options or {}
+    nperseg = int(options.get("nperseg", 2.0) * fs)
+    overlap = options.get("overlap")
+    csd = rp.CrossSpectra(len(columns), fs=fs, nperseg=nperseg,
+                          noverlap=None if overlap is None else int(overlap * nperseg))
+    cor = rp.RunningCorrelation(columns)
+    accumulators = [csd, cor]
+    if time_options is not None:
+        band_time = rp.SlidingBandPower(bands, len(columns), fs=fs, **time_options)
+        accumulators.append(band_time)
+    if synchrony:
+        sync = rp.PhaseSynchrony(bands, len(columns), fs=fs)
+        accumulators.append(sync)
+    for block in blocks:
+        for acc in accumulators:
+            acc.add(block)
+    freqs, S = csd.result()
+    psd_df = pd.DataFrame(np.real(np.diagonal(S, axis1=1, axis2=2)), index=freqs, columns=columns)
+    band_index = rp.BandIndex(bands, freqs)
+    abs_df = rp.pot_abs(psd_df, bands, band_index)
+    tables = {"psd_df": psd_df,
+              "peaks_df": rp.band_peaks(psd_df, bands, band_index),
+              "abs_df": abs_df,
+              "rel_df": rp.pot_rel(abs_df),
+              "cor_df": cor.result(),
+              "coh_df": rp.csd_coh(freqs, S, bands, columns),
+              "pdif_df": rp.csd_phase_dif(freqs, S, bands, columns)}
+    if time_options is not None:
+        tables.update(band_time.result(columns))
+    if synchrony:
+        tables.update(sync.result(columns))
+    return tables
+
+
+def report_context(name, tables, setup, bands, fs, output_folder):
+    """
+    Return the dictionary handed to the report template
+    """
+    context = {"name": name,
+               "fs": fs,
+               "output": output_folder,
+               "setup": setup,
+               "bands": bands}
+    context.update(tables)
+    return context
+
+
+def write_csv(csv_folder, name, tables):
+    for table in tables:
+        if isinstance(tables[table], pd.DataFrame):
+            tables[table].to_csv(os.path.join(csv_folder, name + "_" + table + ".csv"))
+
+
+def process_file(f, name, setup, bands, fs, template, output_folder, csv_folder=None, store_folder=None,
+                 dtype="float64", sidecar_dir=None, block_size=None,
+                 cache_dir=None, cache_size=2 * 1024**3, render_options=None, profile=None,
+                 spectrum_options=None, estimator="fft", estimator_options=None, time_options=None,
+                 synchrony=False):
+    """
+    Read, analyze and write the report of a single recording, its tables to the result store in
+    `store_folder` (see `store.ResultStore`) and its csv files if `csv_folder` is given.
+    Outputs are named after the input file, so the function can run in any worker process.
+    If `cache_dir` is given, results of unchanged recordings are loaded from the result cache.
+    If `sidecar_dir` is given, parsed text recordings are kept there as `.npy` sidecars, see
+    `report.read_sig`. It is a folder of the cache, and the sidecars count against `cache_size`.
+    If `profile` is given, the stages are recorded to that trace, see `instrument.stage`.
+    If `spectrum_options` is given, the power spectrum is kept in compact form with those
+    arguments, see `report.compact_spectrum`.
+    `estimator` and `estimator_options` select the spectral estimator, see `analyze`. Recordings
+    analyzed in blocks always use Welch estimates, with the segments of `estimator_options`.
+    If `time_options` is given, band power is also computed over sliding windows, see `analyze`.
+    If `synchrony` is true, the phase synchrony tables are also computed, see `analyze`.
+    The outputs of the recording are named `name`, see `report_names`.
+    EDF and BDF recordings (see `edf.EDFReader`) are read by the channel names of `setup`, with the
+    sampling frequency of their header.
+    :returns: name of the report and the result tables
+    """
+    n_channels = len(setup.index)  # TODO: not necesarily true.
+    if profile:
+        instrument.enable(profile)
+    render.configure(**(render_options or {}))
+    with instrument.stage("process_file", file=name):
+        tables = None
+        recording = edf.is_edf(f)
+        if recording:
+            # EDF/BDF headers know their channels and sampling frequency
+            fs = edf.check_recording(f, setup["name"], fs)
+        if cache_dir:
+            with instrument.stage("cache lookup"):
+                results = cache.ResultCache(cache_dir, cache_size)
+                key = results.key(f, {"fs": fs,
+                                      "bands": bands.values.tolist(),
+                                      "setup": setup.values.tolist(),
+                                      "dtype": dtype,
+                                      "block_size": block_size,
+                                      "spectrum": spectrum_options,
+                                      "estimator": estimator,
+                                      "estimator_options": estimator_options,
+                                      "time": time_options,
+                                      "synchrony": synchrony})
+                tables = results.load(key)
+            if tables is not None:
+                print("INFO: Using cached results for file ", f)
+
+        if tables is None:
+            with instrument.stage("analysis"):
+                if block_size:
+                    if recording:
+                        columns, blocks = rp.read_edf_blocks(f, block_size, setup["name"], dtype=np.dtype(dtype))
+                    else:
+                        columns, blocks = rp.read_sig_blocks(f, n_channels, block_size,
+                                                             dtype=np.dtype(dtype), cache=sidecar_dir)
+                    tables = analyze_blocks(columns, blocks, bands, fs, estimator_options, time_options,
+                                            synchrony)
+                else:
+                    if recording:
+                        sig = rp.read_edf(f, setup["name"], dtype=np.dtype(dtype))
+                    else:
+                        sig = rp.read_sig(f, n_channels, dtype=np.dtype(dtype), cache=sidecar_dir)
+                    tables = analyze(sig, bands, fs, estimator, estimator_options, time_options, synchrony)
+                if spectrum_options is not None:
+                    tables["psd_df"] = rp.compact_spectrum(tables["psd_df"], **spectrum_options)
+            if cache_dir:
+                with instrument.stage("cache store"):
+                    results.store(key, tables)
+            elif sidecar_dir:
+                # sidecars count against the size of the cache they are kept in
+                cache.ResultCache(os.path.dirname(sidecar_dir), cache_size).evict()
+        if store_folder:
+            with instrument.stage("store"):
+                store.ResultStore(store_folder).write(name, tables)
+        if csv_folder:
+            with instrument.stage("write_csv"):
+                write_csv(csv_folder, name, tables)
+        try:
+            with instrument.stage("report"):
+                render.weave(template,
+                             os.path.join(output_folder, name + ".html"),
+                             report_context(name, tables, setup, bands, fs, output_folder))
+        finally:
+            if multiprocessing.parent_process() is not None:
+                # batch workers exit through os._exit, without running the atexit handlers
+                render.shutdown()
+    return name, tables
+
+
 def main():
     dir_path  = os.path.dirname(os.path.realpath(__file__))
     parser    = create_parser(dir_path)
     args      = parser.parse_args()
     fs        = args.fs
-    cache_dir = os.path.join(dir_path, "cache")
     MULTIPLE  = False
 
     if args.setup:
@@ -52,37 +457,27 @@ def main():
         setup = rp.read_chsetup()  # TODO variable to dump
     setup = pd.DataFrame(setup)
     setup.columns = ["x", "y", "name"]
+    setup[["x", "y"]] = setup[["x", "y"]].astype(float)
 
     if args.bands:
         # TODO: implement
         raise NotImplementedError("ERROR: Not yet implemented")
     else:
-        band_names = ["delta",
-                      "theta",
-                      "alpha1",
-                      "alpha2",
-                      "beta1",
-                      "beta2",
-                      "gamma"]
-        band_lows  = [1, 4, 8, 11, 14, 20, 31]
-        band_highs = [4, 8, 11, 14, 20, 31, 50]
-        bands = rp.create_bands(band_names, band_lows, band_highs)  # TODO variable to dump
+        bands = default_bands()  # TODO variable to dump
     template = args.template
     files = []
 
     output_folder = args.output
     csv_folder = os.path.join(output_folder, "csv")
     if os.path.isdir(args.input):
-        files = [os.path.join(args.input, i) for i in os.listdir(args.input)]
-        if len(files) > 1:
-            MULTIPLE = True
+        files = sorted(os.path.join(args.input, i) for i in os.listdir(args.input)
+                       if os.path.isfile(os.path.join(args.input, i)) and not i.endswith(".npy"))
     elif os.path.isfile(args.input):
         files = [args.input]
     else:
         raise IOError("ERROR: file or folder not found")
-
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir)
+    files, names = report_names(files)
+    MULTIPLE = len(files) > 1
 
     if not (os.path.exists(output_folder)):
         os.makedirs(output_folder)
@@ -90,114 +485,119 @@ def main():
         shutil.rmtree(output_folder)
         os.makedirs(output_folder)
 
-    if not (os.path.exists(csv_folder)):
-        os.makedirs(csv_folder)
-    if not (os.path.isdir(csv_folder)):
-        shutil.rmtree(csv_folder)
-        os.makedirs(csv_folder)
-
-    os.makedirs(cache_dir)
-    bands.to_csv(os.path.join(cache_dir, "bands"), index=False)
-    setup.to_csv(os.path.join(cache_dir, "setup"), index=False)
-    pd.DataFrame({"freq": [fs],
-                  "output": [args.output]}).to_csv(os.path.join(cache_dir, "other"), index=False)
-    n_channels = len(setup.index)  # TODO: not necesarily true.
+    if args.csv:
+        if not (os.path.exists(csv_folder)):
+            os.makedirs(csv_folder)
+        if not (os.path.isdir(csv_folder)):
+            shutil.rmtree(csv_folder)
+            os.makedirs(csv_folder)
+    else:
+        csv_folder = None
 
-    psd_df = pd.DataFrame()
-    peaks_df = pd.DataFrame()
-    abs_df = pd.DataFrame()
-    rel_df = pd.DataFrame()
-    cor_df = pd.DataFrame()
-    coh_df = pd.DataFrame()
-    pdif_df = pd.DataFrame()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    render_options = {"jobs": args.render_jobs if args.render_jobs > 0 else os.cpu_count(),
+                      "max_pending": args.max_figures,
+                      "format": args.image_format,
+                      "dpi": args.dpi,
+                      "embed": args.embed,
+                      "budget": int(args.report_budget * 1024**2) if args.report_budget else None}
+    render.configure(**render_options)
+    profile = None
+    if args.profile:
+        profile = os.path.join(output_folder, "profile.jsonl")
+        instrument.enable(profile, truncate=True)
+    spectrum_options = None
+    if args.compact_spectrum:
+        resolution = args.spectrum_resolution
+        if resolution is None and MULTIPLE:
+            resolution = GROUP_RESOLUTION
+        spectrum_options = {"fmax": args.spectrum_max if args.spectrum_max else float(bands["high"].max()),
+                            "resolution": resolution}
+    # the fft estimator has no segments, but block mode always uses Welch segments of this length
+    estimator_options = {"nperseg": args.segment, "overlap": args.overlap}
+    if args.estimator == "multitaper":
+        estimator_options["bandwidth"] = args.bandwidth
+    task = functools.partial(process_file,
+                             setup=setup,
+                             bands=bands,
+                             fs=fs,
+                             template=template,
+                             output_folder=output_folder,
+                             csv_folder=csv_folder,
+                             store_folder=os.path.join(output_folder, "results") if args.store else None,
+                             dtype=args.dtype,
+                             sidecar_dir=os.path.join(args.cache_dir, cache.SIGNALS) if args.sidecar else None,
+                             block_size=args.block_size,
+                             cache_dir=args.cache_dir if args.cache else None,
+                             cache_size=args.cache_size * 1024**2,
+                             render_options=render_options,
+                             profile=profile,
+                             spectrum_options=spectrum_options,
+                             estimator=args.estimator,
+                             estimator_options=estimator_options,
+                             time_options={"window": args.time_window,
+                                           "overlap": args.time_overlap} if args.time_resolved else None,
+                             synchrony=args.synchrony)
 
-    n = 0
-    for f in files:
-        print("INFO: Processing file ", f)
-        # shutil.copyfile(f, os.path.join(cache_dir, "temp"))
-        pd.DataFrame({"name": [f]}).to_csv(os.path.join(cache_dir, "name"), index=False)
-        # sig    = rp.read_sig(os.path.join(dir_path, "cache", "temp"), n_channels)
-        sig    = rp.read_sig(f, n_channels)
-        psd_df, phase_df = rp.sig_to_frequency(sig, fs=fs)
-        peaks_df = rp.band_peaks(psd_df, bands)
-        abs_df = rp.pot_abs(psd_df, bands)
-        rel_df = rp.pot_rel(abs_df)
-        cor_df = sig.corr()
-        coh_df = rp.coh(sig, bands, fs=fs)
-        pdif_df = rp.phase_dif(phase_df, bands)
-
-        if MULTIPLE:
-            if n == 0:
-                avg_psd   = np.array([psd_df.as_matrix()], np.float64)
-                avg_peaks = np.array([peaks_df.as_matrix()], np.float64)
-                avg_abs   = np.array([abs_df.as_matrix()], np.float64)
-                avg_rel   = np.array([rel_df.as_matrix()], np.float64)
-                avg_cor   = np.array([cor_df.as_matrix()], np.float64)
-                avg_coh   = np.array([coh_df.as_matrix()], np.float64)
-                avg_pdif  = np.array([pdif_df.as_matrix()], np.float64)
-                n += 1
-            avg_psd   = np.concatenate((avg_psd, [psd_df.as_matrix()]), axis=0)
-            avg_peaks = np.concatenate((avg_peaks, [peaks_df.as_matrix()]), axis=0)
-            avg_abs   = np.concatenate((avg_abs, [abs_df.as_matrix()]), axis=0)
-            avg_rel   = np.concatenate((avg_rel, [rel_df.as_matrix()]), axis=0)
-            avg_cor   = np.concatenate((avg_cor, [cor_df.as_matrix()]), axis=0)
-            avg_coh   = np.concatenate((avg_coh, [coh_df.as_matrix()]), axis=0)
-            avg_pdif  = np.concatenate((avg_pdif, [pdif_df.as_matrix()]), axis=0)
-            n += 1
-
-        psd_df.to_csv(os.path.join(cache_dir, "psd_df"))
-        peaks_df.to_csv(os.path.join(cache_dir, "peaks_df"))
-        abs_df.to_csv(os.path.join(cache_dir, "abs_df"))
-        rel_df.to_csv(os.path.join(cache_dir, "rel_df"))
-        cor_df.to_csv(os.path.join(cache_dir, "cor_df"))
-        coh_df.to_csv(os.path.join(cache_dir, "coh_df"))
-        pdif_df.to_csv(os.path.join(cache_dir, "pdif_df"))
-
-        psd_df.to_csv(os.path.join(csv_folder, str(n) + "psd_df.csv"))
-        peaks_df.to_csv(os.path.join(csv_folder, str(n) + "peaks_df.csv"))
-        abs_df.to_csv(os.path.join(csv_folder, str(n) + "abs_df.csv"))
-        rel_df.to_csv(os.path.join(csv_folder, str(n) + "rel_df.csv"))
-        cor_df.to_csv(os.path.join(csv_folder, str(n) + "cor_df.csv"))
-        coh_df.to_csv(os.path.join(csv_folder, str(n) + "coh_df.csv"))
-        pdif_df.to_csv(os.path.join(csv_folder, str(n) + "pdif_df.csv"))
-
-        w = pweave.Pweb(template,
-                        doctype="md2html",
-                        output=os.path.join(output_folder, "Group_Average" + ".html"))
-        w.weave()
+    groups = None
+    if args.groups:
+        groups = stats.read_groups(args.groups).set_index("file")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        if jobs == 1:
+            results = map(task, files, names)
+        else:
+            results = executor.map(task, files, names)
+        averaged = TABLES + (SYNCHRONY_TABLES if args.synchrony else [])
+        group = {t: rp.RunningStats(t) for t in averaged}
+        compared = {}
+        for i, (name, tables) in enumerate(results):
+            print("INFO: [{}/{}] Processed file {}".format(i + 1, len(files), files[i]))
+            if MULTIPLE:
+                for t in averaged:
+                    try:
+                        group[t].add(tables[t])
+                    except ValueError as e:
+                        hint = " Spectra need a common --spectrum-resolution, without --full-spectrum." if t == "psd_df" else ""
+                        raise ValueError("ERROR: " + files[i] + " can not be averaged with the previous recordings: " +
+                                         str(e).replace("ERROR: ", "", 1) + "." + hint)
+            if groups is not None and name in groups.index:
+                compared[name] = {t: tables[t] for t in stats.STAT_TABLES}
 
     if MULTIPLE:
         print("INFO: Processing Group Average ")
-        avg_psd   = pd.DataFrame(np.mean(avg_psd, axis=0), columns=psd_df.columns, index=psd_df.index)
-        avg_peaks = pd.DataFrame(np.mean(avg_peaks, axis=0), columns=peaks_df.columns, index=peaks_df.index)
-        avg_abs   = pd.DataFrame(np.mean(avg_abs, axis=0), columns=abs_df.columns, index=abs_df.index)
-        avg_rel   = pd.DataFrame(np.mean(avg_rel, axis=0), columns=rel_df.columns, index=rel_df.index)
-        avg_cor   = pd.DataFrame(np.mean(avg_cor, axis=0), columns=cor_df.columns, index=cor_df.index)
-        avg_coh   = pd.DataFrame(np.mean(avg_coh, axis=0), columns=coh_df.columns, index=coh_df.index)
-        avg_pdif  = pd.DataFrame(np.mean(avg_pdif, axis=0), columns=pdif_df.columns, index=pdif_df.index)
-
-        pd.DataFrame({"name": ["Group_Average"]}).to_csv(os.path.join(cache_dir, "name"), index=False)
-        avg_psd.to_csv(os.path.join(cache_dir, "psd_df"))
-        avg_peaks.to_csv(os.path.join(cache_dir, "peaks_df"))
-        avg_abs.to_csv(os.path.join(cache_dir, "abs_df"))
-        avg_rel.to_csv(os.path.join(cache_dir, "rel_df"))
-        avg_cor.to_csv(os.path.join(cache_dir, "cor_df"))
-        avg_coh.to_csv(os.path.join(cache_dir, "coh_df"))
-        avg_pdif.to_csv(os.path.join(cache_dir, "pdif_df"))
-
-        avg_psd.to_csv(os.path.join(csv_folder, "Gropup_avg" + "psd_df.csv"))
-        avg_peaks.to_csv(os.path.join(csv_folder, "Gropup_avg" + "peaks_df.csv"))
-        avg_abs.to_csv(os.path.join(csv_folder, "Gropup_avg" + "abs_df.csv"))
-        avg_rel.to_csv(os.path.join(csv_folder, "Gropup_avg" + "rel_df.csv"))
-        avg_cor.to_csv(os.path.join(csv_folder, "Gropup_avg" + "cor_df.csv"))
-        avg_coh.to_csv(os.path.join(csv_folder, "Gropup_avg" + "coh_df.csv"))
-        avg_pdif.to_csv(os.path.join(csv_folder, "Gropup_avg" + "pdif_df.csv"))
-
-        w = pweave.Pweb(template,
-                        doctype="md2html",
-                        output=os.path.join(output_folder, "Group_Average" + ".html"))
-        w.weave()
-    # shutil.rmtree(cache_dir)
+        avg = {}
+        for t in averaged:
+            avg[t] = group[t].mean()
+            avg[t + "_std"] = group[t].std()
+            avg[t + "_sem"] = group[t].sem()
+        if compared:
+            print("INFO: Comparing groups with {} permutations".format(args.permutations))
+            names = sorted(compared)
+            with instrument.stage("group comparison", file="Group_Average"):
+                avg.update(stats.compare_groups([compared[n] for n in names],
+                                                groups.loc[names, "group"].tolist(),
+                                                groups.loc[names, "subject"].tolist() if "subject" in groups else None,
+                                                design=args.design,
+                                                setup=setup,
+                                                n_permutations=args.permutations,
+                                                correction=args.correction,
+                                                cluster_alpha=args.cluster_alpha,
+                                                seed=args.seed,
+                                                jobs=jobs))
+            avg["alpha"] = args.alpha
+            avg["groups"] = " vs ".join(dict.fromkeys(groups.loc[names, "group"]))
+        with instrument.stage("group average", file="Group_Average"):
+            if csv_folder:
+                write_csv(csv_folder, "Group_Average", avg)
+            render.weave(template,
+                         os.path.join(output_folder, "Group_Average.html"),
+                         report_context("Group_Average", avg, setup, bands, fs, output_folder))
+
+    if profile:
+        instrument.chrome_trace(profile, os.path.join(output_folder, "profile.json"))
+        print("INFO: Hottest stages, trace in " + os.path.join(output_folder, "profile.json"))
+        print(instrument.summary(profile))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,420 @@
+"""
+Online band analysis of a recording while it is being acquired.
+Samples arrive from a local socket or a growing file, in the tab separated format of
+`report.read_sig`. Band power, relative power, peaks and coherence of the latest window are
+updated as every block arrives and published at a fixed rate.
+
+    python online.py --socket 127.0.0.1:5555
+    python online.py --follow recording.txt --output live.jsonl
+
+A finished recording can be replayed in real time as a stand-in for the acquisition system:
+
+    python online.py --replay recording.txt --serve 5555
+    python online.py --replay recording.txt --to growing.txt
+"""
+import io
+import os
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+import pandas as pd
+import report as rp
+import main as app
+
+
+class RingBuffer(object):
+    """
+    Last `size` samples of every channel
+    :param n_channels: number of channels
+    :param size: number of samples kept
+    """
+
+    def __init__(self, n_channels, size):
+        self.size = size
+        self.data = np.zeros((size, n_channels))
+        self.pos = 0
+        self.count = 0
+
+    def extend(self, block):
+        """
+        Add a block of samples (samples x channels), overwriting the oldest ones
+        """
+        block = np.asarray(block, dtype=np.float64)[-self.size:]
+        n = block.shape[0]
+        end = self.pos + n
+        if end <= self.size:
+            self.data[self.pos:end] = block
+        else:
+            first = self.size - self.pos
+            self.data[self.pos:] = block[:first]
+            self.data[:n - first] = block[first:]
+        self.pos = end % self.size
+        self.count += n
+
+    def latest(self, n=None):
+        """
+        Return the last `n` samples in order, all the buffered ones by default
+        """
+        n = min(self.size if n is None else n, self.count, self.size)
+        return np.roll(self.data, -self.pos, axis=0)[self.size - n:]
+
+
+class SlidingSpectra(rp.CrossSpectra):
+    """
+    Welch cross spectral density matrix of the last `n_segments` segments, updated incrementally.
+    The spectrum of every new segment is kept in a ring, so adding a block only adds the new
+    segments and removes the ones leaving the window. The sum is recomputed from the ring every
+    time it wraps around, so rounding errors do not build up.
+    :param n_channels: number of channels of every block
+    :param fs: sampling frequency
+    :param nperseg: samples per segment
+    :param n_segments: number of segments in the window
+    :param window: window passed to `scipy.signal.get_window`
+    """
+
+    def __init__(self, n_channels, fs=500, nperseg=256, n_segments=8, window='hann'):
+        super(SlidingSpectra, self).__init__(n_channels, fs=fs, nperseg=nperseg, window=window)
+        self.n_segments = n_segments
+        self.total = 0
+        self._X = np.zeros((n_segments, len(self.freqs), n_channels), np.complex128)
+        self._pos = 0
+
+    def add(self, data):
+        """
+        Add the next block of samples
+        :param data: 2-D array with one signal per column
+        """
+        data = np.concatenate((self._tail, np.asarray(data, dtype=np.float64)))
+        n_seg = max(0, (data.shape[0] - self.nperseg) // self.step + 1)
+        self._tail = data[n_seg * self.step:].copy()
+        if n_seg == 0:
+            return
+        # only the segments that stay in the window are transformed
+        starts = np.arange(max(0, n_seg - self.n_segments), n_seg) * self.step
+        seg = data[starts[:, None] + np.arange(self.nperseg)]   # segments x samples x channels
+        seg = seg - seg.mean(axis=1, keepdims=True)
+        X = np.fft.rfft(seg * self.win[:, None], axis=1)         # segments x freqs x channels
+        for x in X:
+            if self.n_seg == self.n_segments:
+                old = self._X[self._pos]
+                self._S -= old[:, :, None].conj() * old[:, None, :]
+            else:
+                self.n_seg += 1
+            self._X[self._pos] = x
+            self._S += x[:, :, None].conj() * x[:, None, :]
+            self._pos = (self._pos + 1) % self.n_segments
+            if self._pos == 0:
+                ring = self._X.transpose(1, 2, 0)                 # freqs x channels x segments
+                self._S = ring.conj() @ ring.transpose(0, 2, 1)
+        self.total += n_seg
+
+
+class OnlineAnalysis(object):
+    """
+    Band analysis of the latest window of a stream of samples.
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param columns: channel names
+    :param fs: sampling frequency
+    :param window: length of the analyzed window in seconds
+    :param nperseg: samples per segment of the spectra
+    """
+
+    def __init__(self, bands, columns, fs=500, window=4, nperseg=256):
+        self.bands = bands
+        self.columns = list(columns)
+        self.fs = fs
+        self.buffer = RingBuffer(len(self.columns), int(window * fs))
+        n_segments = max(1, (int(window * fs) - nperseg) // (nperseg // 2) + 1)
+        self.spectra = SlidingSpectra(len(self.columns), fs, nperseg, n_segments)
+        self.band_index = rp.BandIndex(bands, self.spectra.freqs)
+        self.arrival = None
+
+    @property
+    def samples(self):
+        return self.buffer.count
+
+    def add(self, block):
+        """
+        Add a block of samples (samples x channels)
+        """
+        self.buffer.extend(block)
+        self.spectra.add(block)
+        self.arrival = time.time()
+
+    def result(self):
+        """
+        Return the tables of the latest window: `abs_df`, `rel_df`, `peaks_df`, `coh_df` and `cor_df`,
+        plus the stream `time` in seconds
+        """
+        freqs, S = self.spectra.result()
+        psd_df = pd.DataFrame(np.real(np.diagonal(S, axis1=1, axis2=2)), index=freqs, columns=self.columns)
+        abs_df = rp.pot_abs(psd_df, self.bands, self.band_index)
+        return {"time": self.samples / float(self.fs),
+                "abs_df": abs_df,
+                "rel_df": rp.pot_rel(abs_df),
+                "peaks_df": rp.band_peaks(psd_df, self.bands, self.band_index),
+                "coh_df": rp.csd_coh(freqs, S, self.bands, self.columns),
+                "cor_df": pd.DataFrame(self.buffer.latest(), columns=self.columns).corr()}
+
+
+class LineParser(object):
+    """
+    Parser of a tab separated stream in the format of `report.read_sig`: a header with the
+    channel names and one line of samples per row. Bytes can be fed in pieces of any size.
+    :param n_channels: number of channels used, extra columns are ignored
+    :param rem_len: characters removed from the end of the channel names, see `report.read_sig`
+    """
+
+    def __init__(self, n_channels, rem_len=5):
+        self.n_channels = n_channels
+        self.rem_len = rem_len
+        self.columns = None
+        self._partial = b""
+
+    def feed(self, data):
+        """
+        Parse the next bytes of the stream
+        :returns: array with the complete rows (samples x channels), possibly empty
+        """
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        if self.columns is None and lines:
+            header = lines.pop(0).decode("utf-8").rstrip("\r").split("\t")[:self.n_channels]
+            self.columns = [c[0:-self.rem_len] if self.rem_len else c for c in header]
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return np.zeros((0, self.n_channels))
+        return np.loadtxt(io.BytesIO(b"\n".join(lines)), delimiter="\t",
+                          usecols=range(self.n_channels), ndmin=2)
+
+
+async def socket_source(host, port, parser, chunk=65536):
+    """
+    Yield blocks of samples read from a TCP connection, see `LineParser`
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            data = await reader.read(chunk)
+            if not data:
+                break
+            block = parser.feed(data)
+            if len(block):
+                yield block
+    finally:
+        writer.close()
+
+
+async def file_source(path, parser, poll=0.05, timeout=5.0, chunk=65536):
+    """
+    Yield blocks of samples appended to a growing file, see `LineParser`.
+    The stream ends once the file has not grown for `timeout` seconds.
+    """
+    idle = 0.0
+    with open(path, "rb") as fh:
+        while idle < timeout:
+            data = fh.read(chunk)
+            if not data:
+                await asyncio.sleep(poll)
+                idle += poll
+                continue
+            idle = 0.0
+            block = parser.feed(data)
+            if len(block):
+                yield block
+
+
+async def monitor(source, parser, bands, fs=500, window=4, rate=1.0, publish=None):
+    """
+    Analyze a stream of samples and publish the tables of the latest window `rate` times per second.
+    Blocks are added as soon as they arrive, so the latency of a result is at most one period
+    plus the time to compute it.
+    :param source: async iterator of sample blocks, e.g. `socket_source` or `file_source`
+    :param parser: `LineParser` of the source, which knows the channel names
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param fs: sampling frequency
+    :param window: length of the analyzed window in seconds
+    :param rate: results per second
+    :param publish: function receiving the result dictionaries, see `OnlineAnalysis.result`.
+                    Each result also holds its `latency` in seconds since its last samples arrived.
+    :returns: number of results published
+    """
+    publish = publish or print_result
+    state = {"analysis": None, "done": False}
+
+    async def ingest():
+        try:
+            async for block in source:
+                if state["analysis"] is None:
+                    state["analysis"] = OnlineAnalysis(bands, parser.columns, fs, window)
+                state["analysis"].add(block)
+        finally:
+            state["done"] = True
+
+    task = asyncio.ensure_future(ingest())
+    published = 0
+    last = 0
+    period = 1.0 / rate
+    next_time = time.time() + period
+    while not state["done"]:
+        await asyncio.sleep(max(0.0, next_time - time.time()))
+        next_time += period
+        analysis = state["analysis"]
+        if analysis is None or analysis.spectra.n_seg == 0 or analysis.samples == last:
+            continue
+        last = analysis.samples
+        result = analysis.result()
+        result["latency"] = time.time() - analysis.arrival
+        publish(result)
+        published += 1
+    await task
+    return published
+
+
+def print_result(result):
+    rel = result["rel_df"].mean(axis=1)
+    print("t={:8.2f}s latency={:6.1f}ms ".format(result["time"], 1000 * result["latency"]) +
+          " ".join("{}={:.2f}".format(band, value) for band, value in rel.items()))
+
+
+class JsonLinesPublisher(object):
+    """
+    Append every result as a JSON line: stream time, latency and the band tables as nested lists
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, result):
+        record = {"time": result["time"], "latency": result["latency"]}
+        for key in ("abs_df", "rel_df", "coh_df"):
+            record[key] = result[key].values.tolist()
+        with open(self.path, "a") as fh:
+            fh.write(json.dumps(record) + "\n")
+        print_result(result)
+
+
+def _replay_lines(path, fs, speed, block):
+    """
+    Yield the header and then blocks of `block` seconds of lines of a recording, paced in real time
+    """
+    with open(path, "rb") as fh:
+        yield fh.readline()
+        n = max(1, int(block * fs))
+        start = time.time()
+        sent = 0
+        while True:
+            lines = [fh.readline() for i in range(n)]
+            lines = [line for line in lines if line]
+            if not lines:
+                break
+            sent += len(lines)
+            yield b"".join(lines)
+            delay = start + sent / (fs * speed) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+async def serve_replay(path, port, fs=500, speed=1.0, block=0.1, host="127.0.0.1"):
+    """
+    Stand-in acquisition server: stream a recording in real time to every client connecting to
+    `host:port`, in `block` seconds long pieces. `speed` > 1 replays faster than real time.
+    """
+    async def handle(reader, writer):
+        with open(path, "rb") as fh:
+            writer.write(fh.readline())
+            n = max(1, int(block * fs))
+            start = time.time()
+            sent = 0
+            while True:
+                lines = [line for line in (fh.readline() for i in range(n)) if line]
+                if not lines:
+                    break
+                writer.write(b"".join(lines))
+                await writer.drain()
+                sent += len(lines)
+                await asyncio.sleep(max(0.0, start + sent / (fs * speed) - time.time()))
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def replay_to_file(path, output, fs=500, speed=1.0, block=0.1):
+    """
+    Stand-in acquisition: append a recording to `output` in real time
+    """
+    with open(output, "wb") as out:
+        for data in _replay_lines(path, fs, speed, block):
+            out.write(data)
+            out.flush()
+
+
+def create_parser(dir_path=os.path.dirname(os.path.realpath(__file__))):
+    parser = argparse.ArgumentParser(prog="Reportes online",
+                                     description="Online band analysis of EEG signals during acquisition.",
+                                     add_help=True)
+    parser.add_argument("--socket",
+                        help="HOST:PORT of the acquisition stream")
+    parser.add_argument("--follow",
+                        help="Growing file with the acquisition stream")
+    parser.add_argument("--replay",
+                        help="Recording replayed in real time, see --serve and --to")
+    parser.add_argument("--serve",
+                        help="Port where --replay serves the recording",
+                        type=int)
+    parser.add_argument("--to",
+                        help="File where --replay appends the recording")
+    parser.add_argument("--speed",
+                        help="Replay speed, 1 is real time",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--setup", "-s",
+                        help="File with the channel setup")
+    parser.add_argument("--frequency", "-f",
+                        help='Samling frequency of the signals',
+                        dest='fs',
+                        type=int,
+                        default=500)
+    parser.add_argument("--window", "-w",
+                        help="Length in seconds of the analyzed window",
+                        type=float,
+                        default=4.0)
+    parser.add_argument("--rate", "-r",
+                        help="Results published per second",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--output", "-o",
+                        help="JSON lines file where the results are appended")
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    if args.replay:
+        if args.serve:
+            asyncio.run(serve_replay(args.replay, args.serve, args.fs, args.speed))
+        elif args.to:
+            replay_to_file(args.replay, args.to, args.fs, args.speed)
+        else:
+            raise ValueError("ERROR: --replay needs --serve or --to")
+        return
+
+    setup = rp.read_chsetup(args.setup) if args.setup else rp.read_chsetup()
+    parser = LineParser(len(setup))
+    if args.socket:
+        host, port = args.socket.rsplit(":", 1)
+        source = socket_source(host, int(port), parser)
+    elif args.follow:
+        source = file_source(args.follow, parser)
+    else:
+        raise ValueError("ERROR: --socket or --follow is needed")
+    publish = JsonLinesPublisher(args.output) if args.output else print_result
+    asyncio.run(monitor(source, parser, app.default_bands(), args.fs, args.window, args.rate, publish))
+
+
+if __name__ == "__main__":
+    main()
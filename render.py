@@ -0,0 +1,418 @@
+import io
+import os
+import base64
+import hashlib
+import copy
+import sys
+import atexit
+import multiprocessing
+import concurrent.futures
+import matplotlib
+import matplotlib.pyplot as plt
+import pweave
+from pweave.processors import IPythonProcessor
+from pweave.formatters.publish import PwebMDtoHTMLFormatter
+import report as rp
+import instrument
+
+
+# Figure rendering settings, see `configure`
+_config = {"jobs": 1,
+           "max_pending": 4,
+           "format": "png",
+           "dpi": 100,
+           "embed": True,
+           "budget": None}
+_pool = None
+
+# Image formats of the reports and their mimetypes
+FORMATS = {"png": "image/png",
+           "jpeg": "image/jpeg",
+           "svg": "image/svg+xml"}
+
+
+def configure(**kwargs):
+    """
+    Set the figure rendering options
+    :param jobs: worker processes rendering figures. 1 renders in this process
+    :param max_pending: maximum number of figures submitted but not yet consumed
+    :param format: image format of the figures, one of `FORMATS`
+    :param dpi: resolution of the images, also the maximum for the figures of the template chunks
+    :param embed: embed the images in the html reports, otherwise they are written as asset files
+    :param budget: maximum bytes of images embedded in a report, see `Assets`. None for no limit
+    """
+    unknown = set(kwargs) - set(_config)
+    if unknown:
+        raise ValueError("ERROR: unknown rendering options " + ", ".join(sorted(unknown)))
+    if kwargs.get("format", "png") not in FORMATS:
+        raise ValueError("ERROR: unknown image format " + kwargs["format"])
+    if "jobs" in kwargs and kwargs["jobs"] != _config["jobs"]:
+        shutdown()
+    _config.update(kwargs)
+
+
+def shutdown():
+    """
+    Stop the figure rendering workers. Processes that exit through `os._exit`, like pool
+    workers, do not run `atexit` handlers and must call it before finishing.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn: forking a process running an IPython kernel copies its threads' locks
+        _pool = concurrent.futures.ProcessPoolExecutor(max_workers=_config["jobs"],
+                                                       mp_context=multiprocessing.get_context("spawn"),
+                                                       initializer=_init_worker)
+        atexit.register(shutdown)
+    return _pool
+
+
+def render(func, args=(), fmt="png", dpi=100):
+    """
+    Call a plotting function and return its figures as encoded images.
+    Every figure is closed as soon as it is saved, so nothing is left in pyplot.
+    :param func: function returning a `(fig, ax)` tuple or a list of them
+    :param args: arguments of `func`
+    :returns: list of images as bytes
+    """
+    result = func(*args)
+    if isinstance(result, tuple):
+        result = [result]
+    images = []
+    for fig, ax in result:
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt, dpi=dpi, bbox_inches="tight")
+        plt.close(fig)
+        images.append(buf.getvalue())
+    return images
+
+
+def figures(func, tasks):
+    """
+    Render `func(*args)` for every `args` in `tasks` and yield the images in order.
+    With more than one rendering job the figures are drawn in worker processes, and at most
+    `max_pending` tasks are in flight, which bounds the images held in memory.
+    :param func: module level plotting function returning `(fig, ax)` or a list of them
+    :param tasks: iterable of argument tuples
+    """
+    fmt = _config["format"]
+    dpi = _config["dpi"]
+    if _config["jobs"] == 1:
+        for args in tasks:
+            for image in render(func, args, fmt, dpi):
+                yield image
+        return
+
+    pool = _get_pool()
+    pending = []
+    for args in tasks:
+        pending.append(pool.submit(render, func, args, fmt, dpi))
+        if len(pending) >= _config["max_pending"]:
+            for image in pending.pop(0).result():
+                yield image
+    for future in pending:
+        for image in future.result():
+            yield image
+
+
+def show(func, tasks):
+    """
+    Render the figures of `func` for every argument tuple in `tasks` (see `figures`) and display
+    them in the running IPython kernel, e.g. from a report template.
+    """
+    from IPython.display import Image, SVG, display
+    for image in figures(func, tasks):
+        if _config["format"] == "svg":
+            display(SVG(data=image))
+        else:
+            display(Image(data=image, format=_config["format"]))
+
+
+class ContextProcessor(IPythonProcessor):
+    """
+    Pweave processor that keeps its kernel running between reports and hands every report its
+    context. With the default `python3` kernel Pweave runs an embedded IPython kernel, so the
+    context is pushed into its namespace as `report_context` without serializing anything.
+    Code chunks with the option `static=True` only run the first time, later runs reuse their output.
+    """
+
+    def __init__(self, *args):
+        super(ContextProcessor, self).__init__(*args)
+        self.static = {}
+
+    def push(self, context, store=None):
+        """
+        Make `context` available to the template as `report_context`
+        :param store: `.npz` path used to hand the context to a kernel running in another process
+        """
+        kernel = getattr(self.km, "kernel", None)
+        if kernel is not None:
+            kernel.shell.push({"report_context": context})
+        else:
+            rp.save_results(store, context)
+            self.loadstring("import report\n"
+                            "report_context = report.load_results({!r})".format(os.path.abspath(store)))
+
+    def set_figure_format(self):
+        """
+        Make the figures of the template chunks use the configured image format only
+        """
+        self.loadstring("%config InlineBackend.figure_formats = [{!r}]".format(_config["format"]))
+
+    def pre_run_hook(self, chunk):
+        chunk["dpi"] = min(chunk["dpi"], _config["dpi"])
+        super(ContextProcessor, self).pre_run_hook(chunk)
+
+    def ensureDirectoryExists(self, figdir):
+        # figures are stored by the formatter, see `Assets`
+        pass
+
+    def _runcode(self, chunk):
+        static = chunk["type"] == "code" and chunk["options"].get("static", False)
+        if static and chunk["number"] in self.static:
+            return copy.deepcopy(self.static[chunk["number"]])
+        if chunk["type"] == "code":
+            with instrument.stage("chunk " + str(chunk["options"].get("name") or chunk["number"])):
+                result = super(ContextProcessor, self)._runcode(chunk)
+        else:
+            result = super(ContextProcessor, self)._runcode(chunk)
+        if static:
+            self.static[chunk["number"]] = copy.deepcopy(result)
+        return result
+
+    def close(self):
+        # Pweave closes the processor after every run, the kernel is stopped by `shutdown`
+        pass
+
+    def shutdown(self):
+        super(ContextProcessor, self).close()
+
+
+class Assets(object):
+    """
+    Images of one report.
+    Embedded images go into the html as data URIs and repeated images are embedded only once,
+    later copies take the source of the first one when the page loads.
+    Other images are written once per image content as `<folder>/assets/<sha256>.<ext>`, shared
+    by all the reports of the folder, and loaded lazily by the browser.
+    :param folder: folder of the html reports
+    :param embed: embed the images in the html
+    :param budget: maximum bytes of embedded images, the images over it are written as asset files.
+                   None for no limit
+    """
+
+    def __init__(self, folder, embed=True, budget=None):
+        self.folder = folder
+        self.embed = embed
+        self.budget = budget
+        self.embedded = set()
+        self.size = 0
+        self.repeated = 0
+        self.spilled = 0
+
+    def image(self, data, mimetype, width):
+        """
+        Store an image and return its html tag
+        :param data: encoded image as bytes
+        :param mimetype: mimetype of the image, one of the values of `FORMATS`
+        :param width: width attribute of the tag
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if self.embed:
+            if digest in self.embedded:
+                self.repeated += 1
+                return '<img data-asset="{}" width="{}"/>\n'.format(digest, width)
+            uri = "data:{};base64,{}".format(mimetype, base64.b64encode(data).decode("ascii"))
+            if self.budget is None or self.size + len(uri) <= self.budget:
+                self.size += len(uri)
+                self.embedded.add(digest)
+                return '<img id="asset-{}" src="{}" width="{}"/>\n'.format(digest, uri, width)
+            self.spilled += 1
+        return '<img src="{}" width="{}" loading="lazy"/>\n'.format(self.write(digest, data, mimetype), width)
+
+    def write(self, digest, data, mimetype):
+        """
+        Write an image to the asset folder, unless it is already there, and return its relative path
+        """
+        ext = {v: k for k, v in FORMATS.items()}[mimetype]
+        name = digest + "." + ext.replace("jpeg", "jpg")
+        path = os.path.join(self.folder, "assets", name)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        return "assets/" + name
+
+    def script(self):
+        """
+        Return the script that fills in the repeated embedded images
+        """
+        if not self.repeated:
+            return ""
+        return ('<script>document.querySelectorAll("img[data-asset]").forEach(function (img) {'
+                'img.src = document.getElementById("asset-" + img.dataset.asset).src;});</script>\n')
+
+
+class ReportFormatter(PwebMDtoHTMLFormatter):
+    """
+    Markdown to html formatter of the reports. Each distinct documentation chunk is converted only
+    once, and figures are stored through `assets` (see `Assets`) instead of Pweave's figure folder.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ReportFormatter, self).__init__(*args, **kwargs)
+        self.fig_mimetypes = list(FORMATS.values())
+        self.converted = {}
+        self.assets = None
+
+    def format_docchunk(self, chunk):
+        key = (chunk.get("number"), chunk["content"])
+        if key not in self.converted:
+            self.converted[key] = super(ReportFormatter, self).format_docchunk(chunk)
+        return self.converted[key]
+
+    def figures_from_chunk(self, chunk):
+        figs = []
+        for out in chunk["result"]:
+            if out["output_type"] != "display_data":
+                continue
+            for mimetype in self.fig_mimetypes:
+                if mimetype in out["data"]:
+                    data = out["data"][mimetype]
+                    if mimetype == FORMATS["svg"]:
+                        data = data.encode("utf-8")
+                    else:
+                        data = base64.b64decode(data)
+                    figs.append(self.assets.image(data, mimetype, chunk["width"]))
+                    break
+        return figs
+
+    def formatfigure(self, chunk):
+        figstring = "".join(chunk["figure"])
+        if not chunk["caption"]:
+            return figstring
+        labelstring = 'data-label = "fig:%s"' % chunk["name"] if chunk["name"] else ""
+        return ("<figure>\n%s<figcaption %s>%s</figcaption>\n</figure>"
+                % (figstring, labelstring, chunk["caption"]))
+
+    def add_footer(self):
+        self.formatted += self.assets.script()
+        super(ReportFormatter, self).add_footer()
+
+
+def embedded(kernel):
+    """
+    Return True if Pweave runs `kernel` inside this process
+    """
+    return kernel == "python3"
+
+
+class Renderer(object):
+    """
+    Report renderer that reads the template once and keeps its kernel running between reports,
+    so the imports and setup of the template are paid once per process instead of once per file.
+    :param template: Pweave markdown template
+    :param output_folder: folder of the html reports
+    :param kernel: jupyter kernel used to run the template
+    """
+
+    def __init__(self, template, output_folder, kernel="python3"):
+        self.kernel = kernel
+        self.output_folder = output_folder
+        self.doc = pweave.Pweb(template,
+                               kernel=kernel,
+                               output=os.path.join(output_folder, "report.html"))
+        self.doc.setformat(Formatter=ReportFormatter)
+        self.processor = None
+
+    def render(self, name, context):
+        """
+        Run the template with `context` and write the report `<output_folder>/<name>.html`.
+        Images are embedded or written as assets according to the rendering options, see `configure`.
+        :param name: name of the report
+        :param context: dictionary with the report inputs and result tables, see `report.save_results`
+        """
+        output = os.path.join(self.output_folder, name + ".html")
+        # The embedded IPython kernel replaces __main__, which worker processes need to unpickle tasks
+        main_module = sys.modules["__main__"]
+        try:
+            if self.processor is None:
+                with instrument.stage("start kernel"):
+                    self.processor = ContextProcessor(None, self.kernel, self.doc.source,
+                                                      False, self.doc.figdir, self.doc.wd)
+            self.processor.push(context, os.path.splitext(output)[0] + ".npz")
+            self.processor.set_figure_format()
+            self.processor.parsed = copy.deepcopy(self.doc.parsed)
+            with instrument.stage("run template"):
+                self.processor.run()
+            self.doc.executed = self.processor.getresults()
+        finally:
+            sys.modules["__main__"] = main_module
+        assets = Assets(self.output_folder, _config["embed"], _config["budget"])
+        self.doc.formatter.assets = assets
+        self.doc.output = output
+        with instrument.stage("format report"):
+            self.doc.format()
+            self.doc.write()
+        if assets.spilled:
+            print("WARNING: {} images of report {} are over its size budget and were written to {}".format(
+                assets.spilled, name, os.path.join(self.output_folder, "assets")))
+
+    def close(self):
+        """
+        Stop the kernel of the renderer
+        """
+        if self.processor is not None:
+            self.processor.shutdown()
+            self.processor = None
+
+
+_renderers = {}
+
+
+def renderer(template, output_folder, kernel="python3"):
+    """
+    Return the renderer of `template` for this process, creating it the first time
+    """
+    key = (os.path.abspath(template), os.path.abspath(output_folder), kernel)
+    if key not in _renderers:
+        if not _renderers:
+            atexit.register(close)
+        _renderers[key] = Renderer(template, output_folder, kernel)
+    return _renderers[key]
+
+
+def close():
+    """
+    Stop the kernels of all the renderers of this process
+    """
+    while _renderers:
+        _renderers.popitem()[1].close()
+
+
+def weave(template, output, context, kernel="python3"):
+    """
+    Weave `template` into `output` (html) with the given report context, reusing the renderer
+    of the template (see `renderer`).
+    Kernels running in a separate process can not receive the context in memory, so it is
+    stored next to the report as `.npz` and loaded by the kernel before the template runs.
+    :param template: Pweave markdown template
+    :param output: path of the html report
+    :param context: dictionary with the report inputs and result tables, see `report.save_results`
+    :param kernel: jupyter kernel used to run the template
+    """
+    name = os.path.splitext(os.path.basename(output))[0]
+    renderer(template, os.path.dirname(output), kernel).render(name, context)
@@ -1,41 +1,193 @@
+import os
+import hashlib
 import pandas as pd
 import numpy as np
 from scipy import signal
-import networkx as nx
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import matplotlib
+import matplotlib.collections
 import scipy.interpolate
+import scipy.fft
+import scipy.spatial
+import instrument
+import edf
 
+__version__ = "0.5.3"
 
-def read_sig(path, n_channels, header=None, sep='\t', rem_len=5):
+
+@instrument.timed
+def read_sig(path, n_channels, header=None, sep='\t', rem_len=5, dtype=np.float64, cache=None):
     """
     Read signal in tabular format (csv, tsv)
+    Only the first `n_channels` columns are parsed, straight into a contiguous array of `dtype`.
     :param path: path of the tabular data file
     :param n_channels: number of channels to be handled. Extra channels will be ignored
     :param sep: tabular data separator. Default `tab`
     :param rem_len: Length of removed characters from column names. Used to remove A1A2 reference.
+    :param dtype: numeric type of the samples, `np.float64` or `np.float32`
+    :param cache: folder of the `.npy` sidecars. If given, the parsed samples are kept there and
+                  loaded on later calls while `path` keeps its size and modification time.
     """
-    signals = sig = []
     try:
-        signals = pd.read_csv(path, sep=sep)
-        sig = signals.iloc[:, 0:n_channels]
-    except:
+        columns = pd.read_csv(path, sep=sep, nrows=0).columns[0:n_channels]
+        data = None
+        if cache:
+            data = _read_sidecar(path, cache, len(columns), dtype)
+        if data is None:
+            data = pd.read_csv(path,
+                               sep=sep,
+                               usecols=range(len(columns)),
+                               dtype=dtype,
+                               engine="c").values
+            data = np.ascontiguousarray(data)
+            if cache:
+                _write_sidecar(path, cache, data)
+    except (IOError, ValueError):
         raise IOError(str("Error: could not read file " + path))
     # TODO
     if not header:
-        header = [i for i in sig.columns]
+        header = [i for i in columns]
     if rem_len:
         header = [i[0:-rem_len] for i in header]
-    sig.columns = header
+    sig = pd.DataFrame(data, columns=header, copy=False)
     return sig
 
 
+def _sidecar_path(path, folder, dtype):
+    """
+    Return the sidecar of `path` in `folder`, named after the absolute path, size and
+    modification time of the recording, so a replaced recording never matches an old sidecar,
+    and after the numeric type of the samples
+    """
+    st = os.stat(path)
+    prefix = hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:32]
+    return os.path.join(folder, prefix + "-" + str(st.st_size) + "-" + str(st.st_mtime_ns) + "-" +
+                        np.dtype(dtype).name + ".npy")
+
+
+def _read_sidecar(path, folder, n_channels, dtype, mmap_mode=None):
+    """
+    Return the samples stored in the sidecar of `path` in `folder`, or None if it is missing or stale.
+    The sidecar is marked as recently used for the eviction of the cache, see `cache.ResultCache`.
+    :param mmap_mode: passed to `np.load`, "r" memory maps the samples instead of loading them
+    """
+    try:
+        sidecar = _sidecar_path(path, folder, dtype)
+        data = np.load(sidecar, mmap_mode=mmap_mode)
+        os.utime(sidecar)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.ndim != 2 or data.shape[1] != n_channels or data.dtype != dtype:
+        return None
+    return data
+
+
+def _write_sidecar(path, folder, data):
+    """
+    Store `data` in the sidecar of `path` in `folder`, removing the sidecars of older versions
+    of the recording. Unwritable folders are silently skipped.
+    """
+    try:
+        sidecar = _sidecar_path(path, folder, data.dtype)
+        os.makedirs(folder, exist_ok=True)
+    except (IOError, OSError):
+        return
+    prefix, size, mtime = os.path.basename(sidecar).split("-")[0:3]
+    version = "-".join([prefix, size, mtime]) + "-"
+    temp = os.path.join(folder, "." + os.path.basename(sidecar) + "." + str(os.getpid()))
+    try:
+        with open(temp, "wb") as f:
+            np.save(f, data)
+        os.replace(temp, sidecar)
+        for name in os.listdir(folder):
+            if name.startswith(prefix + "-") and not name.startswith(version):
+                os.remove(os.path.join(folder, name))
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def read_sig_blocks(path, n_channels, block_size, header=None, sep='\t', rem_len=5,
+                    dtype=np.float64, cache=None):
+    """
+    Read signal in tabular format (csv, tsv) in blocks of `block_size` samples, so memory is
+    bounded by the block size instead of the recording length. A valid sidecar (see
+    `read_sig`) is memory mapped instead of parsed.
+    :param path: path of the tabular data file
+    :param n_channels: number of channels to be handled. Extra channels will be ignored
+    :param block_size: number of samples per block
+    :param sep: tabular data separator. Default `tab`
+    :param rem_len: Length of removed characters from column names. Used to remove A1A2 reference.
+    :param dtype: numeric type of the samples, `np.float64` or `np.float32`
+    :param cache: folder of the `.npy` sidecars, see `read_sig`
+    :returns: channel names and an iterator over 2-D arrays (samples x channels)
+    """
+    try:
+        columns = pd.read_csv(path, sep=sep, nrows=0).columns[0:n_channels]
+    except (IOError, ValueError):
+        raise IOError(str("Error: could not read file " + path))
+    if not header:
+        header = [i for i in columns]
+    if rem_len:
+        header = [i[0:-rem_len] for i in header]
+
+    data = None
+    if cache:
+        data = _read_sidecar(path, cache, len(columns), dtype, mmap_mode="r")
+
+    def blocks():
+        if data is not None:
+            for i in range(0, data.shape[0], block_size):
+                yield np.asarray(data[i:i + block_size])
+            return
+        reader = pd.read_csv(path,
+                             sep=sep,
+                             usecols=range(len(columns)),
+                             dtype=dtype,
+                             engine="c",
+                             chunksize=block_size)
+        for chunk in reader:
+            yield chunk.values
+
+    return header, blocks()
+
+
+@instrument.timed
+def read_edf(path, channels=None, n_channels=None, start=0, stop=None, dtype=np.float64):
+    """
+    Read signal from an EDF, EDF+ or BDF recording, see `edf.EDFReader`.
+    Only the samples of the selected channels and time range are decoded.
+    :param path: path of the recording
+    :param channels: channel names to read, e.g. those of the setup. Labels like "EEG Fp1-A1A2" match "Fp1"
+    :param n_channels: number of channels read when `channels` is not given
+    :param start: first sample
+    :param stop: sample after the last one. Defaults to the end of the recording
+    :param dtype: numeric type of the samples, `np.float64` or `np.float32`
+    """
+    reader = edf.EDFReader(path)
+    selected = reader.select(channels, n_channels)
+    data = reader.read(selected, start, stop, dtype)
+    header = list(channels) if channels is not None else [reader.channels[i] for i in selected]
+    return pd.DataFrame(data, columns=header, copy=False)
+
+
+def read_edf_blocks(path, block_size, channels=None, n_channels=None, dtype=np.float64):
+    """
+    Read signal from an EDF, EDF+ or BDF recording in blocks of `block_size` samples, see `read_edf`
+    :returns: channel names and an iterator over 2-D arrays (samples x channels)
+    """
+    reader = edf.EDFReader(path)
+    selected = reader.select(channels, n_channels)
+    header = list(channels) if channels is not None else [reader.channels[i] for i in selected]
+    return header, reader.blocks(selected, block_size, dtype)
+
+
 def read_chsetup(path=None, sep='\t'):
     if path:
         setup = []
         try:
-            return pd.read_csv(path, sep)
+            return pd.read_csv(path, sep=sep)
         except:
             raise IOError()
     setup = np.array([[0.3,   1.0,    "Fp1"],
@@ -68,48 +220,205 @@ def create_bands(band_names, band_lows, band_highs):
     return df[["name", "low", "high"]]
 
 
-def psd(sig, fs=500, window='hanning', nperseg=1):
+class BandIndex(object):
+    """
+    Bin boundaries of every band over a sorted frequency axis.
+    Bands follow pandas label slicing, so both `low` and `high` are inclusive.
+    Build it once per frequency axis and share it between the band reductions.
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param freqs: sorted frequency axis of the spectra to be reduced
+    """
+
+    def __init__(self, bands, freqs):
+        self.names = bands["name"]
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.start = np.searchsorted(self.freqs, bands["low"].values, side="left")
+        self.stop = np.searchsorted(self.freqs, bands["high"].values, side="right")
+
+    def __len__(self):
+        return len(self.start)
+
+    def reduce(self, values, func):
+        """
+        Apply `func` over the frequency axis (first axis) of `values` for every band.
+        :param values: array with frequencies as first axis, e.g. bins x channels
+        :param func: numpy reduction accepting an `axis` keyword, e.g. `np.sum`
+        :returns: array with bands as first axis and the remaining axes of `values`
+        """
+        values = np.asarray(values)
+        out = np.full((len(self),) + values.shape[1:], np.nan,
+                      dtype=np.result_type(values.dtype, np.float64))
+        for b, (start, stop) in enumerate(zip(self.start, self.stop)):
+            if stop > start:
+                out[b] = func(values[start:stop], axis=0)
+        return out
+
+    def sum(self, values):
+        # as pandas sums, NaNs are skipped and empty bands are 0
+        out = self.reduce(values, np.nansum)
+        out[self.stop <= self.start] = 0
+        return out
+
+    def mean(self, values):
+        return self.reduce(values, np.mean)
+
+    def integrate(self, values):
+        """
+        Return the integral of a density over every band: the sum of its bins times the bin width,
+        e.g. band power in uV^2 from a power spectral density in uV^2/Hz
+        """
+        width = self.freqs[1] - self.freqs[0] if len(self.freqs) > 1 else 1.0
+        return self.sum(values) * width
+
+    def peaks(self, values):
+        """
+        Return the frequency and value of the maximum of every band.
+        :param values: array with frequencies as first axis, e.g. bins x channels
+        :returns: tuple of arrays (bands x channels) with peak frequencies and peak values
+        """
+        values = np.asarray(values)
+        freqs = np.full((len(self),) + values.shape[1:], np.nan)
+        pots = np.full_like(freqs, np.nan)
+        for b, (start, stop) in enumerate(zip(self.start, self.stop)):
+            if stop > start:
+                pos = np.argmax(values[start:stop], axis=0)
+                freqs[b] = self.freqs[start + pos]
+                pots[b] = np.take_along_axis(values[start:stop], pos[None], axis=0)[0]
+        return freqs, pots
+
+
+@instrument.timed
+def psd(sig, fs=500, window='hann', nperseg=1, overlap=None):
     """
+    Return the power spectral density of every channel estimated with Welch's method.
+    All channels are estimated in a single call.
+    :param sig: Dataframe containing one signal per column
     :param fs: sampling frequency
     :param window: Desired window to use. See [get_window](https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.signal.get_window.html#scipy.signal.get_window) for a list of windows and required parameters.
-    :param nperseg: Segments per second. Defaults to 1.
+    :param nperseg: Length of the segments in seconds. Defaults to 1.
+    :param overlap: Fraction of a segment overlapping the next one. Defaults to half a segment.
 
     Window types:
     boxcar, triang, blackman, hamming, hann, bartlett, flattop, parzen, bohman, blackmanharris, nuttall, barthann, kaiser (needs beta), gaussian (needs std), general_gaussian (needs power, width), slepian (needs width), chebwin (needs attenuation)
     """
-    if nperseg > fs:
-        raise AssertionError("Sampling frequency cannot be bigger than window size")
-    psds = sig.copy().apply(signal.welch,
-                            axis=0,
-                            args=(fs,
-                                  window,
-                                  nperseg * fs)
-                            )
-    psd_df = pd.DataFrame(columns=list(sig.columns.values),
-                          index=psds[0][0])
-    for column, i in zip(psd_df, psds):
-        psd_df[column] = i[1]
-    return psd_df
+    length = min(int(nperseg * fs), len(sig.index))
+    noverlap = None if overlap is None else int(overlap * length)
+    freqs, power = signal.welch(np.asarray(sig, dtype=np.float64), fs, window,
+                                nperseg=length, noverlap=noverlap, axis=0)
+    return pd.DataFrame(power, index=freqs, columns=sig.columns)
+
 
+@instrument.timed
+def multitaper_psd(sig, fs=500, nperseg=4, overlap=0.5, bandwidth=1.0, batch=32):
+    """
+    Return the power spectral density of every channel estimated with Slepian (DPSS) tapers,
+    averaged over segments so the cost grows linearly with the length of the recording.
+    All channels are transformed together, a batch of segments at a time.
+    :param sig: Dataframe containing one signal per column
+    :param fs: sampling frequency
+    :param nperseg: Length of the segments in seconds
+    :param overlap: Fraction of a segment overlapping the next one
+    :param bandwidth: Half bandwidth of the tapers in Hz. Every segment uses `2 * bandwidth * nperseg - 1` tapers
+    :param batch: number of segments transformed at once, bounds the memory used
+    """
+    data = np.asarray(sig, dtype=np.float64)
+    length = min(int(nperseg * fs), data.shape[0])
+    step = max(1, length - int(overlap * length))
+    nw = bandwidth * length / float(fs)
+    tapers = signal.windows.dpss(length, nw, max(1, int(2 * nw) - 1))
+    segments = np.lib.stride_tricks.sliding_window_view(data, length, axis=0)[::step]
+    freqs = np.fft.rfftfreq(length, 1.0 / fs)
+    power = np.zeros((len(freqs), data.shape[1]))
+    for start in range(0, len(segments), batch):
+        chunk = segments[start:start + batch]
+        chunk = chunk - chunk.mean(axis=2, keepdims=True)
+        for taper in tapers:
+            power += np.sum(np.abs(np.fft.rfft(chunk * taper, axis=2))**2, axis=0).T
+    power /= len(segments) * len(tapers) * fs
+    # one sided density: fold the negative frequencies, except DC and Nyquist
+    power[1:len(freqs) - (length % 2 == 0)] *= 2
+    return pd.DataFrame(power, index=freqs, columns=sig.columns)
+
+
+# Spectral estimators of `estimate_psd`
+ESTIMATORS = ("fft", "welch", "multitaper")
+
+
+def estimate_psd(sig, fs=500, estimator="fft", **options):
+    """
+    Return the power spectrum of every channel with the selected estimator.
+    All of them are one sided power spectral densities in uV^2/Hz, so their band integrals
+    (see `pot_abs`) agree. `fft` is the periodogram of a single full length transform (see
+    `sig_to_frequency`), `welch` and `multitaper` are averaged over segments (see `psd` and
+    `multitaper_psd`), smaller and less noisy but with the resolution of a segment.
+    :param sig: Dataframe containing one signal per column
+    :param fs: sampling frequency
+    :param estimator: one of `ESTIMATORS`
+    :param options: keyword arguments of the estimator
+    """
+    if estimator == "fft":
+        return sig_to_frequency(sig, fs=fs, **options)[0]
+    if estimator == "welch":
+        return psd(sig, fs=fs, **options)
+    if estimator == "multitaper":
+        return multitaper_psd(sig, fs=fs, **options)
+    raise ValueError("ERROR: unknown spectral estimator " + str(estimator))
+
+
+def spectrum(sig, fs=500):
+    """
+    Return the frequencies and the one sided Fourier transform of every channel.
+    All channels are transformed in a single real input FFT.
+    :param sig: Dataframe (or 2-D array) containing one signal per column
+    :param fs: Sampling frequency
+    :returns: tuple with the non-negative frequencies and a complex array (frequencies x channels)
+    """
+    data = np.asarray(sig, dtype=np.float64)
+    freqs = np.fft.rfftfreq(data.shape[0], 1 / fs)
+    return freqs, np.fft.rfft(data, axis=0)
 
+
+@instrument.timed
 def sig_to_frequency(sig, fs=500):
     """
-    Return the power spectrum and phase of a given signal as data frames
+    Return the power spectral density (one sided periodogram, uV^2/Hz) and phase of a given
+    signal as data frames, indexed by the non-negative frequencies.
     :param sig: Dataframe containing one signal per column
     :param fs: Sampling frequency
     """
-    freq_df = sig.copy().apply(simple_fft,
-                               axis=0,
-                               args=(fs,
-                                     False)
-                               )
-    freq_df.index = simple_fft(freq_df["Cz"], fs=fs, f=True)  # TODO: incompatibility with windows: KeyError: '[0] not in index'
-    phase_df = freq_df.copy().apply(np.angle, axis=0)
-    psd_df = freq_df.apply(lambda x: (np.abs(x) / len(sig.index))**2,
-                           axis=0)
+    freqs, ps = spectrum(sig, fs=fs)
+    n = len(sig.index)
+    power = np.abs(ps)
+    power **= 2
+    power /= n * fs
+    # one sided density: fold the negative frequencies, except DC and Nyquist
+    power[1:len(freqs) - (n % 2 == 0)] *= 2
+    psd_df = pd.DataFrame(power, index=freqs, columns=sig.columns)
+    phase_df = pd.DataFrame(np.angle(ps), index=freqs, columns=sig.columns)
     return psd_df, phase_df
 
 
+@instrument.timed
+def compact_spectrum(psd_df, fmax=None, resolution=None, dtype=np.float32):
+    """
+    Return a compact copy of a power spectrum for storage, plotting and group averages.
+    Band tables must be computed from the full spectrum, this is only for keeping it.
+    :param psd_df: power spectrum indexed by non-negative frequencies, one column per channel
+    :param fmax: highest frequency kept. Bins of `resolution` centered below it are kept whole.
+                 None keeps all of them
+    :param resolution: frequency step in Hz. The power is averaged over bins centered on multiples
+                       of `resolution`, so spectra of recordings with different lengths share the
+                       same frequencies. None keeps the frequencies of `psd_df`
+    :param dtype: numeric type of the stored power
+    """
+    if resolution:
+        psd_df = psd_df.groupby(np.rint(psd_df.index.values / resolution) * resolution).mean()
+        psd_df.index.name = None
+    if fmax is not None:
+        psd_df = psd_df.loc[psd_df.index <= fmax]
+    return psd_df.astype(dtype)
+
+
 def simple_fft(sig, fs=500, f=False):
     """
     receive single signal and return either fourier transform, or frequencies
@@ -129,110 +438,789 @@ def simple_fft(sig, fs=500, f=False):
         return ps[idx]
 
 
-def band_peaks(psd_df, bands):
+@instrument.timed
+def band_peaks(psd_df, bands, band_index=None):
     """
     Return a dataframe with the peak frequency for every band in every channel
 
     :param psd_df: DataFrame with power spectrum density as rows and channels as columns
     :param bands: DataFrame with the desired bands and their cut frequencies
+    :param band_index: Optional `BandIndex` of `bands` over the index of `psd_df`
     """
+    if band_index is None:
+        band_index = BandIndex(bands, psd_df.index)
     A = np.array([i for i in psd_df.columns.values for _ in (0, 1)])
     B = np.array(["Freq", "Pot"] * len(psd_df.columns.values))
     W = [i for i in zip(A, B)]
 
-    max_df = pd.DataFrame(columns=pd.MultiIndex.from_tuples(W))
-    for channel in psd_df:
-        pots  = []
-        freqs = []
-        for index, row in bands.iterrows():
-            freq = float(psd_df[row["low"]:row["high"]][channel].idxmax())
-            pot  = float(psd_df[row["low"]:row["high"]][channel].max())
-            pots.append(pot)
-            freqs.append(freq)
-        max_df[channel, "Freq"] = freqs
-        max_df[channel, "Pot"]  = pots
-        max_df.index = bands["name"]
+    freqs, pots = band_index.peaks(psd_df.values)
+    max_df = pd.DataFrame(np.stack((freqs, pots), axis=2).reshape(len(band_index), -1),
+                          columns=pd.MultiIndex.from_tuples(W),
+                          index=bands["name"])
     return max_df
 
 
-def pot_abs(psd_df, bands):
+@instrument.timed
+def pot_abs(psd_df, bands, band_index=None):
     """
-    Return a dataframe with the abolute power of the given bands for every channel in the dataframe
+    Return a dataframe with the abolute power of the given bands for every channel in the dataframe.
+    The power is the integral of the density over the band, in uV^2 for a density in uV^2/Hz.
 
     :param psd_df: DataFrame with power spectrum density as rows and channels as columns
     :param bands: DataFrame with the desired bands and their cut frequencies
+    :param band_index: Optional `BandIndex` of `bands` over the index of `psd_df`
     """
-    abs_df  = pd.DataFrame(columns=list(psd_df.columns.values),
-                           index=bands["name"])
-    for channel in psd_df:
-        v = []
-        for index, row in bands.iterrows():
-            pot = float(psd_df[row["low"]:row["high"]][channel].sum())
-            v.append(pot)
-        abs_df[channel] = v
-        abs_df.index = bands["name"]
+    if band_index is None:
+        band_index = BandIndex(bands, psd_df.index)
+    abs_df = pd.DataFrame(band_index.integrate(psd_df.values),
+                          columns=list(psd_df.columns.values),
+                          index=bands["name"])
     return abs_df
 
 
+@instrument.timed
 def pot_rel(abs_df):
     """
     Return relative power per band, based on absolute power.
     :param abs_df: Dataframe with absolute power where rows are bands and columns are channels
     """
-    rel_df = abs_df.copy()
-    for col in abs_df:
-        rel_df[col] = abs_df[col] / sum(abs_df[col])
-    return rel_df
+    return abs_df / abs_df.sum(axis=0)
+
+
+class CrossSpectra(object):
+    """
+    Welch cross spectral density matrix of every pair of channels, accumulated block by block.
+    Samples that do not complete a segment are kept until the next block arrives, so feeding a
+    recording in blocks of any size gives the same result as feeding it at once.
+    :param n_channels: number of channels of every block
+    :param fs: sampling frequency
+    :param nperseg: samples per segment
+    :param noverlap: overlapping samples between segments. Defaults to `nperseg // 2`
+    :param window: window passed to `scipy.signal.get_window`
+    :param block: number of segments transformed at a time
+    """
+
+    def __init__(self, n_channels, fs=500, nperseg=256, noverlap=None, window='hann', block=64):
+        if noverlap is None:
+            noverlap = nperseg // 2
+        self.fs = fs
+        self.nperseg = nperseg
+        self.step = nperseg - noverlap
+        self.block = block
+        self.win = signal.get_window(window, nperseg)
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / fs)
+        self.n_seg = 0
+        self._S = np.zeros((len(self.freqs), n_channels, n_channels), np.complex128)
+        self._tail = np.zeros((0, n_channels))
+
+    def add(self, data):
+        """
+        Add the next block of samples
+        :param data: 2-D array with one signal per column
+        """
+        data = np.concatenate((self._tail, np.asarray(data, dtype=np.float64)))
+        n_seg = max(0, (data.shape[0] - self.nperseg) // self.step + 1)
+        starts = np.arange(n_seg) * self.step
+        for i in range(0, n_seg, self.block):
+            idx = starts[i:i + self.block, None] + np.arange(self.nperseg)
+            seg = data[idx]                                   # segments x samples x channels
+            seg = seg - seg.mean(axis=1, keepdims=True)
+            X = np.fft.rfft(seg * self.win[:, None], axis=1)  # segments x freqs x channels
+            X = X.transpose(1, 2, 0)                          # freqs x channels x segments
+            self._S += X.conj() @ X.transpose(0, 2, 1)
+        self.n_seg += n_seg
+        self._tail = data[n_seg * self.step:].copy()
+
+    def result(self):
+        """
+        :returns: frequencies and a complex array of shape (frequencies, channels, channels),
+                  with the same conjugation convention as `scipy.signal.csd`
+        """
+        if self.n_seg == 0:
+            raise ValueError("ERROR: signal shorter than one segment")
+        S = self._S * (1.0 / (self.fs * (self.win * self.win).sum() * self.n_seg))
+        # one sided spectrum, keep DC and Nyquist unscaled
+        if self.nperseg % 2:
+            S[1:] *= 2
+        else:
+            S[1:-1] *= 2
+        return self.freqs, S
+
+
+@instrument.timed
+def cross_spectra(data, fs=500, nperseg=256, noverlap=None, window='hann', block=64):
+    """
+    Return the Welch cross spectral density matrix of every pair of channels.
+    Every channel is windowed and transformed once, and segments are accumulated in blocks
+    so memory is bounded by `block` segments instead of the recording length.
+    :param data: 2-D array (or dataframe) with one signal per column
+    :param fs: sampling frequency
+    :param nperseg: samples per segment. Shortened to the signal length if needed, as scipy does
+    :param noverlap: overlapping samples between segments. Defaults to `nperseg // 2`
+    :param window: window passed to `scipy.signal.get_window`
+    :param block: number of segments transformed at a time
+    :returns: frequencies and a complex array of shape (frequencies, channels, channels),
+              with the same conjugation convention as `scipy.signal.csd`
+    """
+    data = np.asarray(data, dtype=np.float64)
+    nperseg = min(nperseg, data.shape[0])
+    if noverlap is not None:
+        noverlap = min(noverlap, nperseg - 1)
+    acc = CrossSpectra(data.shape[1], fs=fs, nperseg=nperseg, noverlap=noverlap,
+                       window=window, block=block)
+    acc.add(data)
+    return acc.result()
+
+
+@instrument.timed
+def welch_cross_spectra(sig, fs=500, window='hann', nperseg=1, overlap=None):
+    """
+    Return the Welch cross spectral density matrix with the segments of `psd`, so its diagonal is
+    the power spectral density `psd` returns and the signal is only transformed once.
+    :param sig: Dataframe containing one signal per column
+    :param fs: sampling frequency
+    :param window: window passed to `scipy.signal.get_window`
+    :param nperseg: Length of the segments in seconds. Defaults to 1.
+    :param overlap: Fraction of a segment overlapping the next one. Defaults to half a segment.
+    :returns: frequencies and a complex array of shape (frequencies, channels, channels), see `cross_spectra`
+    """
+    length = min(int(nperseg * fs), len(sig.index))
+    noverlap = None if overlap is None else int(overlap * length)
+    return cross_spectra(sig.values, fs=fs, nperseg=length, noverlap=noverlap, window=window)
+
+
+@instrument.timed
+def csd_coh(freqs, S, bands, columns):
+    """
+    Return the coherence averaged over every band from a cross spectral matrix.
+    Coherence is symmetric, so it is returned as a pair table (see `pair_index`).
+    :param freqs: frequencies of `S`
+    :param S: cross spectral matrix (frequencies x channels x channels), see `cross_spectra`
+    :param bands: dataframe with a column for name, lower inclusive frequency and higher inclusive frequency.
+    :param columns: channel names
+    """
+    power = np.real(np.diagonal(S, axis1=1, axis2=2))
+    iu, ju = np.triu_indices(S.shape[1], k=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coh_pairs = np.abs(S[:, iu, ju])**2 / (power[:, iu] * power[:, ju])
+
+    coh_df = pd.DataFrame(BandIndex(bands, freqs).mean(coh_pairs),  # TODO: check if average is correct
+                          columns=pair_index(columns),
+                          index=bands["name"])
+    return coh_df
+
+
+@instrument.timed
+def csd_phase_dif(freqs, S, bands, columns):
+    """
+    Return the phase difference for every band and pair of channels from a cross spectral matrix,
+    as the angle of the band averaged cross spectrum, in a pair table (see `pair_index`). Used when no single full length spectrum
+    is available, e.g. for recordings analyzed in blocks.
+    :param freqs: frequencies of `S`
+    :param S: cross spectral matrix (frequencies x channels x channels), see `cross_spectra`
+    :param bands: dataframe with the desired bands and their cut frequencies
+    :param columns: channel names
+    """
+    iu, ju = np.triu_indices(S.shape[1], k=1)
+    band_S = BandIndex(bands, freqs).reduce(S[:, iu, ju], np.mean)
+    # S[i, j] = conj(X_i) X_j, so the phase of i minus the phase of j is the angle of its conjugate
+    pdif_df = pd.DataFrame(-np.angle(band_S),
+                           columns=pair_index(columns),
+                           index=bands["name"])
+    return pdif_df
 
 
+@instrument.timed
 def coh(sig, bands, fs=500):
     """
     Return the coherence between signals of a dataframe averaged over a frequency band.
+    The cross spectral matrix is computed once for all channels (see `cross_spectra`).
     :param sig: dataframe with a signal for every column
-    :param bands: dataframe with a column for name, lower inclusive frequency and higher non-inclusive frequency.
+    :param bands: dataframe with a column for name, lower inclusive frequency and higher inclusive frequency.
     :param fs: sampling frequency
     """
-    cols = [i + "-" + j for i in sig for j in sig]
-    coh_df = pd.DataFrame(columns=cols)
-    coh_temp = pd.DataFrame()
-    for col1 in sig:
-        for col2 in sig:
-            freq, coh = signal.coherence(sig[col1],
-                                         sig[col2],
-                                         fs)
-            coh_temp["temp"] = coh
-            coh_temp.index = freq
-            v = []
-            for index, row in bands.iterrows():
-                band_coh = float(coh_temp[row["low"]:row["high"]].mean())  # TODO: check if average is correct
-                v.append(band_coh)
-
-            coh_df[col1 + "-" + col2] = v
-
-    coh_df.index = bands["name"]
-    return coh_df
+    freqs, S = cross_spectra(sig.values, fs=fs)
+    return csd_coh(freqs, S, bands, sig.columns)
 
 
-def phase_dif(phase_df, bands):
+@instrument.timed
+def phase_dif(phase_df, bands, band_index=None):
     """
-    Return a dataframe with the phase difference for every band in every channel
+    Return a pair table (see `pair_index`) with the phase difference for every band and pair of channels.
+    The band average of a difference is the difference of the band averages, so only one
+    average per channel and band is computed.
+    :param phase_df: DataFrame with phase as rows and channels as columns
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param band_index: Optional `BandIndex` of `bands` over the index of `phase_df`
     """
-    cols = [i + "-" + j for i in phase_df for j in phase_df]
-    pdif_df = pd.DataFrame(columns=cols)
-    ph_temp = pd.DataFrame()
-    for col1 in phase_df:
-        for col2 in phase_df:
-            ph_temp = phase_df[col1] - phase_df[col2]
-            ph_temp.index = phase_df.index
-            v = []
-            for index, row in bands.iterrows():
-                v.append(float(ph_temp[row["low"]:row["high"]].mean()))
-            pdif_df[col1 + "-" + col2] = v
-    pdif_df.index = bands["name"]
+    if band_index is None:
+        band_index = BandIndex(bands, phase_df.index)
+    band_phase = band_index.mean(phase_df.values)
+    iu, ju = np.triu_indices(band_phase.shape[1], k=1)
+    pdif_df = pd.DataFrame(band_phase[:, iu] - band_phase[:, ju],
+                           columns=pair_index(phase_df.columns),
+                           index=bands["name"])
     return pdif_df
 
 
-def headmap(data, setup, rel=False, N=300):
+def pair_index(channels):
+    """
+    Return the columns of a pair table.
+    Pairwise measures are stored as pair tables: one row per band and one column per unordered
+    pair of different channels `(i, j)`, in the order of the upper triangle of the channels x
+    channels matrix. The value of `(i, j)` is the one of `i` respect to `j`, e.g. phase of `i`
+    minus phase of `j`. See `pair_matrix` and `pair_to_wide` for the full matrices.
+    :param channels: channel names
+    :returns: MultiIndex with levels `ch1` and `ch2`
+    """
+    channels = np.asarray(list(channels))
+    iu, ju = np.triu_indices(len(channels), k=1)
+    return pd.MultiIndex.from_arrays([channels[iu], channels[ju]], names=["ch1", "ch2"])
+
+
+def pair_channels(columns):
+    """
+    Return the channel names of a pair table, see `pair_index`
+    """
+    first = columns[0][0]
+    return [first] + [j for i, j in columns if i == first]
+
+
+def pair_matrix(pair_df, band, diagonal=0.0, antisymmetric=False):
+    """
+    Return the channels x channels matrix of a band of a pair table, see `pair_index`
+    :param pair_df: pair table
+    :param band: name of the band (row)
+    :param diagonal: value of a channel respect to itself, e.g. 1 for coherence
+    :param antisymmetric: True if the value of `(j, i)` is minus the one of `(i, j)`, e.g. phase differences
+    """
+    channels = pair_channels(pair_df.columns)
+    values = pair_df.loc[band].values
+    iu, ju = np.triu_indices(len(channels), k=1)
+    matrix = np.full((len(channels), len(channels)), diagonal, dtype=values.dtype)
+    matrix[iu, ju] = values
+    matrix[ju, iu] = -values if antisymmetric else values
+    return pd.DataFrame(matrix, index=channels, columns=channels)
+
+
+def pair_to_wide(pair_df, diagonal=0.0, antisymmetric=False):
+    """
+    Return a pair table (see `pair_index`) in the wide format: one "ch1-ch2" column for every
+    ordered pair of channels, including each channel with itself. See `pair_matrix` for the options.
+    """
+    channels = pair_channels(pair_df.columns)
+    n = len(channels)
+    values = pair_df.values
+    iu, ju = np.triu_indices(n, k=1)
+    wide = np.full((len(pair_df.index), n, n), diagonal, dtype=values.dtype)
+    wide[:, iu, ju] = values
+    wide[:, ju, iu] = -values if antisymmetric else values
+    return pd.DataFrame(wide.reshape(len(pair_df.index), n * n),
+                        columns=[i + "-" + j for i in channels for j in channels],
+                        index=pair_df.index)
+
+
+class FilterBank(object):
+    """
+    Zero phase Butterworth band-pass filters of every band, applied in the frequency domain.
+    The recording is transformed once and every band is a product and an inverse transform of
+    the positive frequencies only, which gives its analytic signal directly. The gain is the
+    squared response of the filter, as with `scipy.signal.sosfiltfilt`.
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param fs: sampling frequency
+    :param order: order of the Butterworth filters
+    """
+
+    def __init__(self, bands, fs=500, order=4):
+        self.fs = fs
+        self.sos = [signal.butter(order, [low, high], btype="bandpass", fs=fs, output="sos")
+                    for low, high in zip(bands["low"], bands["high"])]
+        self._gains = {}
+
+    def gains(self, n):
+        """
+        Return the bands x frequencies gains of the analytic filters for signals of `n` samples
+        """
+        if n not in self._gains:
+            freqs = np.fft.fftfreq(n, 1 / self.fs)
+            positive = freqs > 0
+            gains = np.zeros((len(self.sos), n))
+            for gain, sos in zip(gains, self.sos):
+                h = signal.sosfreqz(sos, worN=freqs[positive], fs=self.fs)[1]
+                gain[positive] = 2 * np.abs(h)**2
+            # only the gains of the last length are kept
+            self._gains = {n: gains}
+        return self._gains[n]
+
+    def analytic(self, data, pad=None):
+        """
+        Yield the analytic signal (samples x channels) of every band of `data`
+        :param pad: samples of odd extension added to both ends, as `scipy.signal.filtfilt` does,
+                    so the transform does not wrap one end of the signal onto the other.
+                    Defaults to one second
+        """
+        n = data.shape[0]
+        pad = min(n - 1, int(self.fs) if pad is None else pad)
+        data = np.concatenate((2 * data[0] - data[pad:0:-1], data, 2 * data[-1] - data[-2:-pad - 2:-1]))
+        size = scipy.fft.next_fast_len(data.shape[0])
+        X = scipy.fft.fft(data, n=size, axis=0)
+        for gain in self.gains(size):
+            yield scipy.fft.ifft(X * gain[:, None], axis=0)[pad:pad + n]
+
+
+class PhaseSynchrony(object):
+    """
+    Phase locking value, weighted phase lag index and amplitude envelope correlation of every
+    band and pair of channels, accumulated block by block.
+    Samples are filtered with `margin` seconds of the neighbouring samples on both sides, so a
+    block is analyzed when the next one arrives. Without margin every block is filtered on its
+    own, so a recording added at once is filtered whole.
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param n_channels: number of channels of every block
+    :param fs: sampling frequency
+    :param order: order of the Butterworth filters, see `FilterBank`
+    :param margin: seconds of context used to filter every block
+    :param block: pair products computed at a time by the weighted phase lag index, so its
+                  memory does not grow with the square of the number of channels
+    """
+
+    def __init__(self, bands, n_channels, fs=500, order=4, margin=4, block=2**20):
+        self.bands = bands
+        self.bank = FilterBank(bands, fs, order)
+        self.margin = int(margin * fs)
+        self.iu, self.ju = np.triu_indices(n_channels, k=1)
+        self.block = max(1, block // max(1, len(self.iu)))   # samples per block
+        n_bands = len(bands.index)
+        self.n = 0
+        self._plv = np.zeros((n_bands, n_channels, n_channels), np.complex128)
+        self._imag = np.zeros((n_bands, len(self.iu)))
+        self._abs_imag = np.zeros((n_bands, len(self.iu)))
+        self._amp = np.zeros((n_bands, n_channels))
+        self._amp2 = np.zeros((n_bands, n_channels, n_channels))
+        self._left = np.zeros((0, n_channels))
+        self._pending = np.zeros((0, n_channels))
+
+    def add(self, data):
+        """
+        Add the next block of samples
+        :param data: 2-D array with one signal per column
+        """
+        self._pending = np.concatenate((self._pending, np.asarray(data, dtype=np.float64)))
+        if self._pending.shape[0] > self.margin:
+            self._analyze(self._pending.shape[0] - self.margin)
+
+    def _analyze(self, n):
+        """
+        Accumulate the first `n` pending samples
+        """
+        start = self._left.shape[0]
+        data = np.concatenate((self._left, self._pending))
+        for b, Z in enumerate(self.bank.analytic(data)):
+            Z = Z[start:start + n]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                U = Z / np.abs(Z)
+            self._plv[b] += U.T @ U.conj()
+            amp = np.abs(Z)
+            self._amp[b] += amp.sum(axis=0)
+            self._amp2[b] += amp.T @ amp
+            for i in range(0, n, self.block):
+                # imaginary part of the cross spectrum of i respect to j
+                imag = np.imag(Z[i:i + self.block, self.iu] * Z[i:i + self.block, self.ju].conj())
+                self._imag[b] += imag.sum(axis=0)
+                self._abs_imag[b] += np.abs(imag).sum(axis=0)
+        self.n += n
+        self._left = data[start:start + n][-self.margin:] if self.margin else self._left[:0]
+        self._pending = self._pending[n:]
+
+    def result(self, columns):
+        """
+        Analyze the remaining samples and return the pair tables (see `pair_index`) `plv_df`,
+        `wpli_df` and `amp_cor_df`
+        :param columns: channel names
+        """
+        if self._pending.shape[0]:
+            self._analyze(self._pending.shape[0])
+        if self.n == 0:
+            raise ValueError("ERROR: no samples to analyze")
+        index = self.bands["name"]
+        pairs = pair_index(columns)
+        plv = np.abs(self._plv[:, self.iu, self.ju]) / self.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            wpli = np.abs(self._imag) / self._abs_imag
+            mean = self._amp / self.n
+            cov = self._amp2 / self.n - mean[:, :, None] * mean[:, None, :]
+            var = np.diagonal(cov, axis1=1, axis2=2)
+            amp_cor = cov[:, self.iu, self.ju] / np.sqrt(var[:, self.iu] * var[:, self.ju])
+        return {"plv_df": pd.DataFrame(plv, index=index, columns=pairs),
+                "wpli_df": pd.DataFrame(wpli, index=index, columns=pairs),
+                "amp_cor_df": pd.DataFrame(amp_cor, index=index, columns=pairs)}
+
+
+@instrument.timed
+def phase_synchrony(sig, bands, fs=500, order=4):
+    """
+    Return the phase locking value, weighted phase lag index and amplitude envelope correlation
+    of every band and pair of channels as pair tables, see `PhaseSynchrony`.
+    All channels are transformed once, and every band is filtered and turned into its analytic
+    signal with a single inverse transform, see `FilterBank`.
+    :param sig: DataFrame with one signal per column
+    :param bands: DataFrame with the desired bands and their cut frequencies
+    :param fs: sampling frequency
+    :param order: order of the Butterworth filters
+    :returns: dictionary with `plv_df`, `wpli_df` and `amp_cor_df`
+    """
+    acc = PhaseSynchrony(bands, sig.shape[1], fs=fs, order=order, margin=0)
+    acc.add(sig.values)
+    return acc.result(sig.columns)
+
+
+class SlidingBandPower(object):
+    """
+    Band power, relative power and peak frequency of every channel over sliding windows,
+    accumulated block by block like `CrossSpectra`.
+    Every window is a Hann windowed power spectral density, integrated over every band (uV^2)
+    as in `pot_abs`. A batch of windows of all the
+    channels is transformed and reduced to bands at a time, so there is no loop over windows.
+    :param bands: DataFrame with the desired bands and their cut frequencies, see `create_bands`
+    :param n_channels: number of channels of every block
+    :param fs: sampling frequency
+    :param window: length of the windows in seconds
+    :param overlap: fraction of a window overlapping the next one
+    :param block: number of windows transformed at a time
+    """
+
+    def __init__(self, bands, n_channels, fs=500, window=2, overlap=0.5, block=256):
+        self.bands = bands
+        self.fs = fs
+        self.nperseg = int(window * fs)
+        self.step = max(1, self.nperseg - int(overlap * self.nperseg))
+        self.block = block
+        self.win = signal.get_window("hann", self.nperseg)
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / fs)
+        self.band_index = BandIndex(bands, self.freqs)
+        # one sided density, keep DC and Nyquist unscaled
+        self._scale = np.full((len(self.freqs), 1, 1), 2.0 / (fs * (self.win * self.win).sum()))
+        self._scale[0] /= 2
+        if self.nperseg % 2 == 0:
+            self._scale[-1] /= 2
+        self.n_win = 0
+        self._power = []
+        self._peaks = []
+        self._tail = np.zeros((0, n_channels))
+
+    def add(self, data):
+        """
+        Add the next block of samples
+        :param data: 2-D array with one signal per column
+        """
+        data = np.concatenate((self._tail, np.asarray(data, dtype=np.float64)))
+        n_win = max(0, (data.shape[0] - self.nperseg) // self.step + 1)
+        windows = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=0)[::self.step][:n_win]
+        for i in range(0, n_win, self.block):
+            seg = windows[i:i + self.block]                              # windows x channels x samples
+            seg = seg - seg.mean(axis=2, keepdims=True)
+            power = np.abs(np.fft.rfft(seg * self.win, axis=2))**2
+            power = power.transpose(2, 1, 0) * self._scale               # freqs x channels x windows
+            self._power.append(self.band_index.integrate(power))
+            self._peaks.append(self.band_index.peaks(power)[0])
+        self.n_win += n_win
+        self._tail = data[n_win * self.step:].copy()
+
+    def result(self, columns):
+        """
+        :param columns: channel names
+        :returns: dictionary with the `abs_time_df`, `rel_time_df` and `peak_time_df` tables,
+                  indexed by the time of the center of every window in seconds, with a
+                  (band, channel) MultiIndex as columns
+        """
+        if self.n_win == 0:
+            raise ValueError("ERROR: signal shorter than one window")
+        power = np.concatenate(self._power, axis=2)                      # bands x channels x windows
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel = power / power.sum(axis=0)
+        times = pd.Index((np.arange(self.n_win) * self.step + self.nperseg / 2.0) / self.fs, name="time")
+        cols = pd.MultiIndex.from_product([list(self.bands["name"]), list(columns)], names=["band", "channel"])
+
+        def frame(values):
+            return pd.DataFrame(values.reshape(-1, self.n_win).T, index=times, columns=cols)
+        return {"abs_time_df": frame(power),
+                "rel_time_df": frame(rel),
+                "peak_time_df": frame(np.concatenate(self._peaks, axis=2))}
+
+
+@instrument.timed
+def band_power_time(sig, bands, fs=500, window=2, overlap=0.5):
+    """
+    Return band power, relative power and peak frequency of every channel over sliding windows.
+    See `SlidingBandPower`.
+    :param sig: Dataframe containing one signal per column
+    """
+    acc = SlidingBandPower(bands, len(sig.columns), fs=fs, window=window, overlap=overlap)
+    acc.add(sig.values)
+    return acc.result(sig.columns)
+
+
+@instrument.timed
+def time_course(tc_df, title, cmap="viridis"):
+    """
+    Return a compact plot of a time resolved table (see `SlidingBandPower`): one strip per band
+    with the channels as rows and the windows as columns.
+    """
+    bands = tc_df.columns.get_level_values(0).unique()
+    channels = tc_df.columns.get_level_values(1).unique()
+    times = tc_df.index.values
+    values = tc_df.values.T.reshape(len(bands), len(channels), len(times))
+    fig, axes = plt.subplots(len(bands), 1, figsize=(12, 1.2 * len(bands) + .5),
+                             sharex=True, squeeze=False)
+    axes = axes[:, 0]
+    for ax, band, strip in zip(axes, bands, values):
+        im = ax.imshow(strip, aspect="auto", interpolation="nearest", cmap=cmap,
+                       extent=(times[0], times[-1], len(channels) - .5, -.5))
+        ax.set_ylabel(band, rotation=0, horizontalalignment="right", verticalalignment="center")
+        ax.set_yticks([])
+        fig.colorbar(im, ax=ax, pad=.01, fraction=.02)
+    axes[0].set_title(title)
+    axes[-1].set_xlabel("Time (s)")
+    return fig, axes
+
+
+class RunningStats(object):
+    """
+    Running mean and variance of equally shaped tables, one table at a time (Welford's algorithm).
+    Memory does not grow with the number of tables added. Statistics are accumulated in double
+    precision and returned with the numeric type of the first table.
+    :param name: name of the table, used in error messages
+    """
+
+    def __init__(self, name="table"):
+        self.name = name
+        self.n = 0
+        self.index = None
+        self.columns = None
+        self.dtype = None
+        self._mean = None
+        self._m2 = None
+
+    def add(self, df):
+        """
+        Add a table to the statistics
+        :param df: DataFrame with the same index and columns as the previous ones, in the same order
+        """
+        x = np.asarray(df.values, dtype=np.float64)
+        if self.n == 0:
+            self.index = df.index
+            self.columns = df.columns
+            self.dtype = np.result_type(df.values.dtype, np.float32)
+            self._mean = np.zeros_like(x)
+            self._m2 = np.zeros_like(x)
+        elif x.shape != self._mean.shape:
+            raise ValueError("ERROR: " + self.name + " shape " + str(x.shape) +
+                             " does not match " + str(self._mean.shape))
+        elif not (df.index.equals(self.index) and df.columns.equals(self.columns)):
+            raise ValueError("ERROR: " + self.name + " labels do not match those of the previous tables")
+        self.n += 1
+        delta = x - self._mean
+        self._mean += delta / self.n
+        self._m2 += delta * (x - self._mean)
+
+    def _frame(self, values):
+        return pd.DataFrame(values.astype(self.dtype, copy=False), index=self.index, columns=self.columns)
+
+    def mean(self):
+        return self._frame(self._mean.copy())
+
+    def var(self, ddof=1):
+        if self.n <= ddof:
+            return self._frame(np.full_like(self._m2, np.nan))
+        return self._frame(self._m2 / (self.n - ddof))
+
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+
+    def sem(self):
+        """
+        Return the standard error of the mean
+        """
+        return self.std() / np.sqrt(self.n)
+
+
+class RunningCorrelation(object):
+    """
+    Pearson correlation between channels, accumulated block by block with the pairwise
+    update of Chan et al., so blocks can have any size.
+    :param columns: channel names
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.n = 0
+        self._mean = np.zeros(len(columns))
+        self._C = np.zeros((len(columns), len(columns)))
+
+    def add(self, data):
+        """
+        Add the next block of samples
+        :param data: 2-D array with one signal per column
+        """
+        data = np.asarray(data, dtype=np.float64)
+        n_b = data.shape[0]
+        if n_b == 0:
+            return
+        mean_b = data.mean(axis=0)
+        centered = data - mean_b
+        delta = mean_b - self._mean
+        n = self.n + n_b
+        self._C += centered.T @ centered + np.outer(delta, delta) * (self.n * n_b / n)
+        self._mean += delta * (n_b / n)
+        self.n = n
+
+    def result(self):
+        """
+        :returns: DataFrame with the correlation matrix, as `DataFrame.corr`
+        """
+        d = np.sqrt(np.diag(self._C))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cor = self._C / np.outer(d, d)
+        return pd.DataFrame(cor, index=self.columns, columns=self.columns)
+
+
+@instrument.timed
+def save_results(path, results):
+    """
+    Store a dictionary of DataFrames and scalars in a compressed `.npz` file.
+    Numeric DataFrames of a single type are stored as one 2-D array, others one typed array per
+    column, so no pickling is needed to load them back.
+    :param path: path of the `.npz` file
+    :param results: dictionary of DataFrames, strings and numbers
+    """
+    arrays = {}
+    for key, value in results.items():
+        if isinstance(value, pd.DataFrame):
+            arrays[key + "__index"] = _label_array(value.index)
+            arrays[key + "__index_name"] = np.array("" if value.index.name is None else value.index.name)
+            arrays[key + "__columns"] = _label_array(value.columns)
+            arrays[key + "__column_names"] = np.array(["" if n is None else str(n) for n in value.columns.names])
+            dtypes = set(value.dtypes)
+            if len(dtypes) == 1 and np.issubdtype(dtypes.pop(), np.number):
+                arrays[key + "__values"] = value.values
+                continue
+            for i in range(len(value.columns)):
+                column = np.asarray(value.iloc[:, i])
+                if column.dtype == object:
+                    column = column.astype(str)
+                arrays[key + "__" + str(i)] = column
+        else:
+            arrays[key] = np.array(value)
+    np.savez_compressed(path, **arrays)
+
+
+@instrument.timed
+def load_results(path):
+    """
+    Load a dictionary stored with `save_results`
+    :param path: path of the `.npz` file
+    """
+    results = {}
+    with np.load(path, allow_pickle=False) as store:
+        keys = set(store.files)
+        for key in sorted(keys):
+            if key.endswith("__columns"):
+                name = key[:-len("__columns")]
+                columns = _label_index(store[key])
+                index = pd.Index(store[name + "__index"], name=str(store[name + "__index_name"]) or None)
+                if name + "__values" in keys:
+                    df = pd.DataFrame(store[name + "__values"], index=index, columns=columns)
+                else:
+                    data = {i: store[name + "__" + str(i)] for i in range(len(columns))}
+                    df = pd.DataFrame(data, index=index)
+                    df.columns = columns
+                if name + "__column_names" in keys:
+                    df.columns.names = [n or None for n in store[name + "__column_names"].tolist()]
+                results[name] = df
+            elif "__" not in key:
+                results[key] = store[key].item()
+    return results
+
+
+def _label_array(index):
+    """
+    Return the labels of an index as an array, with one column per level for a MultiIndex
+    """
+    if isinstance(index, pd.MultiIndex):
+        return np.array([[str(j) for j in i] for i in index.values])
+    values = np.asarray(index.values)
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def _label_index(values):
+    if values.ndim == 2:
+        return pd.MultiIndex.from_arrays(list(values.T))
+    return pd.Index(values)
+
+
+class InterpolationPlan(object):
+    """
+    Cubic (Clough-Tocher) interpolation of electrode values over a square grid, masked to the
+    scalp circle. The interpolation is linear in the electrode values, so the weights of every
+    electrode on every grid point are computed once and each map is a single matrix product.
+    Maps are the same as `scipy.interpolate.griddata(..., method='cubic')` up to the tolerance
+    of its gradient estimation.
+    :param x: x coordinates of the electrodes
+    :param y: y coordinates of the electrodes
+    :param N: grid points per axis
+    :param xy_center: center of the scalp circle
+    :param radius: radius of the scalp circle
+    """
+
+    def __init__(self, x, y, N=300, xy_center=(.5, .5), radius=.5):
+        self.N = N
+        self.xi = np.linspace(-.1, 1.1, N)
+        self.yi = np.linspace(-.1, 1.1, N)
+
+        # set points > radius to not-a-number. They will not be plotted.
+        # the dr/2 makes the edges a bit smoother
+        dr = self.xi[1] - self.xi[0]
+        r = np.hypot(self.xi[None, :] - xy_center[0], self.yi[:, None] - xy_center[1])
+        self.mask = (r - dr / 2) <= radius
+
+        points = np.column_stack((np.asarray(x, np.float64), np.asarray(y, np.float64)))
+        tri = scipy.spatial.Delaunay(points)
+        interpolator = scipy.interpolate.CloughTocher2DInterpolator(tri, np.eye(len(points)))
+        X, Y = np.meshgrid(self.xi, self.yi)
+        self.weights = interpolator(X[self.mask], Y[self.mask])   # masked points x electrodes
+
+    def interpolate(self, z):
+        """
+        Return the interpolated map (N x N) of the electrode values `z`, NaN outside the scalp
+        """
+        zi = np.full((self.N, self.N), np.nan)
+        zi[self.mask] = self.weights @ np.asarray(z, dtype=np.float64)
+        return zi
+
+
+_interpolation_plans = {}
+
+
+def interpolation_plan(x, y, N=300):
+    """
+    Return the cached `InterpolationPlan` of an electrode layout and grid resolution
+    """
+    key = (tuple(float(i) for i in x), tuple(float(i) for i in y), N)
+    if key not in _interpolation_plans:
+        _interpolation_plans[key] = InterpolationPlan(x, y, N)
+    return _interpolation_plans[key]
+
+
+@instrument.timed
+def headmap(data, setup, rel=False, N=300, mask=None, title=None, cmap=None):
+    """
+    Return the interpolated head map of every row of `data`
+    :param mask: boolean array shaped like `data`, channels where it is true are highlighted
+    :param title: title of the maps, followed by the band. By default absolute or relative power
+    :param cmap: colormap, symmetric around zero when given. Defaults to viridis
+    """
     x = setup['x'].tolist()
     y = setup['y'].tolist()
     plots = []
@@ -241,43 +1229,36 @@ def headmap(data, setup, rel=False, N=300):
         pos[row["name"]] = (row['x'], row['y'])
     radius = .5         # radius
     xy_center = [.5, .5]   # center of the plot
-    for ix, row in data.iterrows():
-        z = row.tolist()
+    plan = interpolation_plan(x, y, N)
+    layout = headnet_layout(setup["name"], pos)
+    xi = plan.xi
+    yi = plan.yi
+    for i, (ix, row) in enumerate(data.iterrows()):
+        zi = plan.interpolate(row.values)
 
-        xi = np.linspace(-.1, 1.1, N)
-        yi = np.linspace(-.1, 1.1, N)
-        zi = scipy.interpolate.griddata((x, y), z,
-                                        (xi[None, :], yi[:, None]),
-                                        method='cubic')
-
-        # set points > radius to not-a-number. They will not be plotted.
-        # the dr/2 makes the edges a bit smoother
-        dr = xi[1] - xi[0]
-        for i in range(N):
-            for j in range(N):
-                r = np.sqrt((xi[i] - xy_center[0])**2 + (yi[j] - xy_center[1])**2)
-                if (r - dr / 2) > radius:
-                    zi[j, i] = "nan"
-
-        G = nx.Graph()
-        G.add_nodes_from(pos)
-        nx.set_node_attributes(G, "pos", pos)
         fig, ax = plt.subplots(1, 1, figsize=(7, 7))
         ax.set_aspect("equal")
 
         # nodes
-        nx.draw_networkx_nodes(G, pos, node_size=70, ax=ax, node_color="cyan")
-        # labels
-    #     nx.draw_networkx_labels(G,pos,font_size=20,font_family='sans-serif')
+        _draw_nodes(ax, layout, color="cyan", labels=False)
+        if mask is not None:
+            marked = np.asarray(mask)[i].astype(bool)
+            ax.scatter(layout.xy[marked, 0], layout.xy[marked, 1], s=150, c="w", edgecolors="k", zorder=3)
 
         # use different number of levels for the fill and the lines
-        im = ax.contourf(xi, yi, zi, 60, cmap=plt.cm.viridis, zorder=1)
+        if cmap is None:
+            im = ax.contourf(xi, yi, zi, 60, cmap=plt.cm.viridis, zorder=1)
+        else:
+            vmax = np.nanmax(np.abs(zi)) or 1.0
+            im = ax.contourf(xi, yi, zi, np.linspace(-vmax, vmax, 61), cmap=cmap, zorder=1)
         ax.contour(xi, yi, zi, 15, colors="grey", zorder=2)
 
         ax.axis("off")
         ax.set_title("Absolute Power band: " + str(ix))
         if rel:
             ax.set_title("Relative Power band: " + str(ix))
+        if title:
+            ax.set_title(title + " band: " + str(ix))
 
         # HEAD
         circle = matplotlib.patches.Circle(xy=xy_center,
@@ -318,64 +1299,68 @@ def headmap(data, setup, rel=False, N=300):
     return plots
 
 
-def cor_headnet(cor_df, pos, tresholds=[-0.8, 0.8]):
+class HeadnetLayout(object):
     """
-    Return correlation network from dataframe and positions
+    Electrode coordinates of a montage and the line segment of every pair of electrodes,
+    shared by all the network plots of the montage.
+    :param channels: channel names, in the order of the tables to be drawn
+    :param pos: dictionary with the (x, y) position of every channel
     """
-    G = nx.Graph()
-    for index, row in cor_df.iterrows():
-        for channel, dat in row.iteritems():
-            G.add_edge(index,
-                       channel,
-                       weight=dat)
 
-    # print(G.edges(data=True))
-    nx.set_node_attributes(G, "pos", pos)
-    fig, ax = plt.subplots(1, 1, figsize=(7, 7))
-    # nodes
-    nx.draw_networkx_nodes(G, pos, node_size=70, ax=ax)
-    # edges
-    elarge   = [(u, v, d) for (u, v, d) in G.edges(data=True) if d['weight'] > tresholds[1]]
-    weights1 = [i[2]["weight"] for i in elarge]
-
-    emedium  = [(u, v, d) for (u, v, d) in G.edges(data=True) if tresholds[0] < d['weight'] <= tresholds[1]]
-    weights2 = [i[2]["weight"] for i in emedium]
-
-    esmall   = [(u, v, d) for (u, v, d) in G.edges(data=True) if d['weight'] <= tresholds[0]]
-    weights3 = [i[2]["weight"] for i in esmall]
-
-    im = nx.draw_networkx_edges(G, pos,
-                                edgelist=elarge,
-                                alpha=1,
-                                width=5,
-                                edge_color=weights1,
-                                edge_cmap=plt.cm.RdBu,
-                                edge_vmin=0,
-                                edge_vmax=1,
-                                ax=ax)
-    nx.draw_networkx_edges(G, pos,
-                           edgelist=emedium,
-                           alpha=0.05,
-                           width=5,
-                           edge_color=weights2,
-                           edge_cmap=plt.cm.RdBu,
-                           edge_vmin=0,
-                           edge_vmax=1,
-                           ax=ax)
-    nx.draw_networkx_edges(G, pos,
-                           edgelist=esmall,
-                           alpha=1,
-                           width=5,
-                           edge_color=weights3,
-                           edge_cmap=plt.cm.RdBu,
-                           edge_vmin=0,
-                           edge_vmax=1,
-                           ax=ax)
-    # labels
-    nx.draw_networkx_labels(G, pos, font_size=20, font_family='sans-serif')
+    def __init__(self, channels, pos):
+        self.channels = list(channels)
+        self.xy = np.array([pos[c] for c in self.channels], dtype=np.float64)
+        self.iu, self.ju = np.triu_indices(len(self.channels), k=1)
+        self.segments = np.stack((self.xy[self.iu], self.xy[self.ju]), axis=1)
+
+    def weights(self, matrix):
+        """
+        Return the edge weights of a channels x channels matrix, one per segment.
+        Like the undirected graphs drawn before, a pair takes the value of its later
+        ordered pair, i.e. `matrix[j, i]` for `i < j`. The segments are in the order of the
+        columns of a pair table, see `pair_index`.
+        """
+        return np.asarray(matrix, dtype=np.float64)[self.ju, self.iu]
+
+
+_headnet_layouts = {}
+
+
+def headnet_layout(channels, pos):
+    """
+    Return the cached `HeadnetLayout` of the given channels and positions
+    """
+    channels = tuple(channels)
+    key = (channels, tuple(tuple(float(v) for v in pos[c]) for c in channels))
+    if key not in _headnet_layouts:
+        _headnet_layouts[key] = HeadnetLayout(channels, pos)
+    return _headnet_layouts[key]
+
+
+def _draw_nodes(ax, layout, color="#1f78b4", labels=True):
+    ax.scatter(layout.xy[:, 0], layout.xy[:, 1], s=70, c=color, zorder=2)
+    if labels:
+        for name, (x, y) in zip(layout.channels, layout.xy):
+            ax.text(x, y, name, fontsize=20, family="sans-serif",
+                    horizontalalignment="center", verticalalignment="center")
+
+
+def _draw_edges(ax, layout, weights, mask, cmap, vmin, vmax, alpha=1):
+    lines = matplotlib.collections.LineCollection(layout.segments[mask],
+                                                  cmap=cmap,
+                                                  norm=plt.Normalize(vmin, vmax),
+                                                  linewidths=5,
+                                                  alpha=alpha,
+                                                  zorder=1)
+    lines.set_array(weights[mask])
+    ax.add_collection(lines)
+    return lines
+
+
+def _draw_headnet(fig, ax, title, im, ticks):
+    ax.autoscale_view()
     ax.axis("off")
-    # plt.savefig("weighted_graph.png") # save as png
-    ax.set_title("Average correlation")
+    ax.set_title(title)
 
     # HEAD
     xy_center = [.5, .5]   # center of the plot
@@ -388,116 +1373,93 @@ def cor_headnet(cor_df, pos, tresholds=[-0.8, 0.8]):
 
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    fig.colorbar(im, cax=cax, ticks=[0, .5, 1])
+    fig.colorbar(im, cax=cax, ticks=ticks)
+
+
+@instrument.timed
+def cor_headnet(cor_df, pos, tresholds=[-0.8, 0.8]):
+    """
+    Return correlation network from dataframe and positions
+    """
+    layout = headnet_layout(cor_df.columns, pos)
+    weights = layout.weights(cor_df.values)
 
+    fig, ax = plt.subplots(1, 1, figsize=(7, 7))
+    # nodes
+    _draw_nodes(ax, layout)
+    # edges
+    im = _draw_edges(ax, layout, weights, weights > tresholds[1], plt.cm.RdBu, 0, 1)
+    _draw_edges(ax, layout, weights, (tresholds[0] < weights) & (weights <= tresholds[1]),
+                plt.cm.RdBu, 0, 1, alpha=0.05)
+    _draw_edges(ax, layout, weights, weights <= tresholds[0], plt.cm.RdBu, 0, 1)
+    _draw_headnet(fig, ax, "Average correlation", im, [0, .5, 1])
     return fig, ax
 
 
-def coh_headnet(coh_df, pos, treshold=0.8):
+@instrument.timed
+def coh_headnet(coh_df, pos, treshold=0.8, title="Coherence"):
     """
-    Return coherence network from dataframe and positions
+    Return coherence network from dataframe and positions.
+    Also draws other pair tables ranging from 0 to 1, e.g. phase locking value, named by `title`
     """
+    channels = pair_channels(coh_df.columns)
+    layout = headnet_layout(channels, pos)
     plots = []
-    for index, band in coh_df.iterrows():
-        G = nx.Graph()
-        for channel_pair, dat in band.iteritems():
-            G.add_edge(channel_pair.split('-')[0],
-                       channel_pair.split('-')[1],
-                       weight=dat)
-        nx.set_node_attributes(G, "pos", pos)
+    for index, weights in zip(coh_df.index, coh_df.values.astype(np.float64)):
         fig, ax = plt.subplots(1, 1, figsize=(7, 7))
         # nodes
-        nx.draw_networkx_nodes(G, pos, node_size=70, ax=ax)
+        _draw_nodes(ax, layout)
         # edges
-        elarge = [(u, v, d) for (u, v, d) in G.edges(data=True) if d['weight'] > treshold]
-        weights1 = [i[2]["weight"] for i in elarge]
-        esmall = [(u, v, d) for (u, v, d) in G.edges(data=True) if d['weight'] <= treshold]
-        weights2 = [i[2]["weight"] for i in esmall]
-
-        im = nx.draw_networkx_edges(G, pos,
-                                    edgelist=elarge,
-                                    alpha=1,
-                                    width=5,
-                                    edge_color=weights1,
-                                    edge_cmap=plt.cm.viridis,
-                                    edge_vmin=0,
-                                    edge_vmax=1,
-                                    ax=ax)
-        nx.draw_networkx_edges(G, pos,
-                               edgelist=esmall,
-                               alpha=0.05,
-                               width=5,
-                               edge_color=weights2,
-                               edge_cmap=plt.cm.viridis,
-                               edge_vmin=0,
-                               edge_vmax=1,
-                               ax=ax)
-        # labels
-        nx.draw_networkx_labels(G, pos, font_size=20, font_family='sans-serif')
-        ax.axis("off")
-        # plt.savefig("weighted_graph.png") # save as png
-        ax.set_title("Coherence " + index)
-
-        # Head
-        xy_center = [.5, .5]   # center of the plot
-        radius = .6         # radius
-        circle = matplotlib.patches.Circle(xy=xy_center,
-                                           radius=radius,
-                                           edgecolor="k",
-                                           facecolor="none")
-        ax.add_patch(circle)
-
-        divider = make_axes_locatable(ax)
-        cax = divider.append_axes("right", size="5%", pad=0.05)
-        fig.colorbar(im, cax=cax, ticks=[0, .5, 1])
-
+        im = _draw_edges(ax, layout, weights, weights > treshold, plt.cm.viridis, 0, 1)
+        _draw_edges(ax, layout, weights, weights <= treshold, plt.cm.viridis, 0, 1, alpha=0.05)
+        _draw_headnet(fig, ax, title + " " + index, im, [0, .5, 1])
         plots.append((fig, ax))
     return plots
 
 
+@instrument.timed
 def phs_headnet(pdif_df, pos):
+    channels = pair_channels(pdif_df.columns)
+    layout = headnet_layout(channels, pos)
     plots = []
-    for index, band in pdif_df.iterrows():
-        G = nx.Graph()
-        for channel_pair, dat in band.iteritems():
-            G.add_edge(channel_pair.split('-')[0],
-                       channel_pair.split('-')[1],
-                       weight=dat)
-        nx.set_node_attributes(G, "pos", pos)
+    # an edge shows the phase of its later channel minus the earlier one, as the graphs drawn before
+    for index, weights in zip(pdif_df.index, -pdif_df.values.astype(np.float64)):
         fig, ax = plt.subplots(1, 1, figsize=(7, 7))
         # nodes
-        nx.draw_networkx_nodes(G, pos, node_size=70, ax=ax)
+        _draw_nodes(ax, layout)
         # edges
-        weights = [i[2]["weight"] for i in G.edges(data=True)]
-
-        im = nx.draw_networkx_edges(G, pos,
-                                    alpha=1,
-                                    width=5,
-                                    edge_color=weights,
-                                    edge_cmap=plt.cm.RdBu,
-                                    edge_vmin=-np.pi,
-                                    edge_vmax=np.pi,
-                                    ax=ax)
-
-        # labels
-        nx.draw_networkx_labels(G, pos, font_size=20, font_family='sans-serif')
-        ax.axis("off")
-        # plt.savefig("weighted_graph.png") # save as png
-        ax.set_title("Phase difference " + index)
+        im = _draw_edges(ax, layout, weights, np.ones(len(weights), bool), plt.cm.RdBu, -np.pi, np.pi)
+        _draw_headnet(fig, ax, "Phase difference " + index, im, [-np.pi, 0, np.pi])  # ,ticklabels=["-π","0","π"])
+        plots.append((fig, ax))
+    return plots
 
-        # HEAD
-        xy_center = [.5, .5]   # center of the plot
-        radius = .6         # radius
-        circle = matplotlib.patches.Circle(xy=xy_center,
-                                           radius=radius,
-                                           edgecolor="k",
-                                           facecolor="none")
-        ax.add_patch(circle)
 
-        divider = make_axes_locatable(ax)
-        cax = divider.append_axes("right", size="5%", pad=0.05)
-        fig.colorbar(im, cax=cax, ticks=[-np.pi, 0, np.pi])  # ,ticklabels=["-π","0","π"])
+def stat_headmap(stat_df, p_df, setup, alpha=0.05, title="t"):
+    """
+    Return the head maps of a group statistic, with the channels where `p_df` is below `alpha` highlighted
+    """
+    return headmap(stat_df, setup, mask=p_df.values < alpha, title=title, cmap=plt.cm.RdBu_r)
+
 
-        # plt.show() # display
+@instrument.timed
+def stat_headnet(stat_df, p_df, pos, alpha=0.05, title="t"):
+    """
+    Return the networks of a group statistic over a pair table, drawing the pairs where `p_df`
+    is below `alpha` and fading the rest
+    """
+    channels = pair_channels(stat_df.columns)
+    layout = headnet_layout(channels, pos)
+    vmax = np.nanmax(np.abs(stat_df.values)) or 1.0
+    vmin = -vmax if (stat_df.values < 0).any() else 0
+    plots = []
+    for index, weights, p in zip(stat_df.index, stat_df.values.astype(np.float64), p_df.values):
+        significant = p < alpha
+        fig, ax = plt.subplots(1, 1, figsize=(7, 7))
+        # nodes
+        _draw_nodes(ax, layout)
+        # edges
+        im = _draw_edges(ax, layout, weights, significant, plt.cm.RdBu_r, vmin, vmax)
+        _draw_edges(ax, layout, weights, ~significant, plt.cm.RdBu_r, vmin, vmax, alpha=0.05)
+        _draw_headnet(fig, ax, "{} {} (p < {})".format(title, index, alpha), im, [vmin, (vmin + vmax) / 2, vmax])
         plots.append((fig, ax))
     return plots
@@ -0,0 +1,265 @@
+"""
+Permutation tests comparing groups of recordings on every cell of the result tables.
+The tables of all the subjects are stacked into one subjects x cells array, and the statistic of
+a whole batch of permutations is computed with a few matrix products. Multiple comparisons are
+corrected with the maximum statistic or the maximum cluster mass over the cells.
+"""
+import numpy as np
+import pandas as pd
+import scipy.stats
+import scipy.sparse
+import scipy.spatial
+import scipy.sparse.csgraph
+import concurrent.futures
+import instrument
+
+DESIGNS = ("independent", "paired")
+CORRECTIONS = ("max", "cluster")
+STAT_TABLES = ["abs_df", "rel_df", "coh_df"]
+
+
+def read_groups(path, sep='\t'):
+    """
+    Read the groups of the recordings, a table with the columns `file` (name of the recording
+    without extension), `group` and, for paired designs, `subject`
+    """
+    try:
+        groups = pd.read_csv(path, sep=sep, dtype=str)
+    except Exception:
+        raise IOError("ERROR: could not read the groups file " + path)
+    missing = {"file", "group"} - set(groups.columns)
+    if missing:
+        raise ValueError("ERROR: missing columns in the groups file: " + ", ".join(sorted(missing)))
+    return groups
+
+
+def stack_tables(tables):
+    """
+    Stack tables with the same labels, one per subject
+    :param tables: list of DataFrames
+    :returns: subjects x rows x columns array, and the index and columns of the tables
+    """
+    first = tables[0]
+    values = np.stack([np.asarray(t.reindex(index=first.index, columns=first.columns).values,
+                                  dtype=np.float64) for t in tables])
+    return values, first.index, first.columns
+
+
+def channel_adjacency(setup):
+    """
+    Return the sparse channels x channels adjacency of a montage: channels are neighbours when
+    they share an edge of the Delaunay triangulation of their positions
+    :param setup: DataFrame with the `x`, `y` and `name` of every channel
+    """
+    xy = setup[["x", "y"]].values.astype(np.float64)
+    n = len(xy)
+    tri = scipy.spatial.Delaunay(xy)
+    edges = np.concatenate([tri.simplices[:, [0, 1]], tri.simplices[:, [1, 2]], tri.simplices[:, [0, 2]]])
+    adjacency = scipy.sparse.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    adjacency = ((adjacency + adjacency.T) > 0).astype(np.float64)
+    return pd.DataFrame(adjacency.toarray(), index=setup["name"].values, columns=setup["name"].values)
+
+
+def pair_adjacency(columns):
+    """
+    Return the adjacency of the pairs of a pair table (see `report.pair_index`): as in the
+    network based statistic, two pairs are neighbours when they share a channel
+    """
+    pairs = np.array([[str(a), str(b)] for a, b in columns])
+    shared = ((pairs[:, None, 0] == pairs[None, :, 0]) | (pairs[:, None, 0] == pairs[None, :, 1]) |
+              (pairs[:, None, 1] == pairs[None, :, 0]) | (pairs[:, None, 1] == pairs[None, :, 1]))
+    np.fill_diagonal(shared, False)
+    return shared.astype(np.float64)
+
+
+class PermutationTest(object):
+    """
+    Permutation test of every cell of stacked tables.
+    With the `independent` design subjects are shuffled between the groups, and the statistic is
+    Student's t (second group minus first) for two groups or the one-way F for more.
+    With the `paired` design `values` are the differences between two conditions of every subject,
+    their signs are flipped at random and the statistic is the one sample t.
+    :param values: subjects x rows x columns array, see `stack_tables`
+    :param groups: group number (0, 1, ...) of every subject, ignored by the `paired` design
+    :param design: one of `DESIGNS`
+    :param correction: `max` statistic or `cluster` mass, see `CORRECTIONS`
+    :param adjacency: columns x columns adjacency, needed by the `cluster` correction.
+                      Clusters join neighbouring columns of the same row.
+    :param cluster_alpha: parametric p-value of the threshold that forms the clusters
+    """
+
+    def __init__(self, values, groups=None, design="independent", correction="max",
+                 adjacency=None, cluster_alpha=0.05):
+        if design not in DESIGNS:
+            raise ValueError("ERROR: unknown design " + str(design))
+        if correction not in CORRECTIONS:
+            raise ValueError("ERROR: unknown correction " + str(correction))
+        n, rows, columns = values.shape
+        self.shape = (rows, columns)
+        self.design = design
+        self.correction = correction
+        if design == "paired":
+            self.X = values.reshape(n, -1)
+            self.two_sided = True
+            self.stat_name = "t"
+            df = (scipy.stats.t, (n - 1,))
+        else:
+            # centered, so the sums of squares below do not lose precision
+            self.X = values.reshape(n, -1) - values.reshape(n, -1).mean(axis=0)
+            self.groups = np.asarray(groups)
+            self.counts = np.bincount(self.groups).astype(np.float64)
+            if len(self.counts) < 2 or (self.counts == 0).any():
+                raise ValueError("ERROR: every group needs at least one subject")
+            self.two_sided = len(self.counts) == 2
+            self.stat_name = "t" if self.two_sided else "F"
+            df = (scipy.stats.t, (n - 2,)) if self.two_sided else \
+                 (scipy.stats.f, (len(self.counts) - 1, n - len(self.counts)))
+        self.sumsq = (self.X**2).sum(axis=0)
+        if correction == "cluster":
+            if adjacency is None:
+                raise ValueError("ERROR: the cluster correction needs an adjacency")
+            dist, args = df
+            self.threshold = dist.ppf(1 - cluster_alpha / 2 if self.two_sided else 1 - cluster_alpha, *args)
+            self.graph = scipy.sparse.kron(scipy.sparse.identity(rows),
+                                           scipy.sparse.csr_matrix(np.asarray(adjacency))).tocsr()
+
+    def permutations(self, rng, n):
+        """
+        Return `n` random relabelings: group numbers for the `independent` design, signs for `paired`
+        """
+        if self.design == "paired":
+            return rng.choice(np.array([-1.0, 1.0]), size=(n, self.X.shape[0]))
+        return rng.permuted(np.tile(self.groups, (n, 1)), axis=1)
+
+    def observed(self):
+        if self.design == "paired":
+            return self.statistic(np.ones((1, self.X.shape[0])))[0]
+        return self.statistic(self.groups[None])[0]
+
+    def statistic(self, labels):
+        """
+        Return the statistic of every cell for a batch of relabelings (permutations x cells)
+        """
+        N = self.X.shape[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.design == "paired":
+                mean = labels @ self.X / N
+                var = (self.sumsq - N * mean**2) / (N - 1)
+                return mean / np.sqrt(var / N)
+            k = len(self.counts)
+            onehot = (labels[:, None, :] == np.arange(k)[None, :, None]).astype(np.float64)
+            sums = onehot @ self.X                                  # permutations x groups x cells
+            means = sums / self.counts[:, None]
+            ssw = self.sumsq - (sums * means).sum(axis=1)
+            if k == 2:
+                return (means[:, 1] - means[:, 0]) / np.sqrt(ssw / (N - 2) * (1 / self.counts).sum())
+            ssb = (self.counts[:, None] * means**2).sum(axis=1)    # the grand mean is zero
+            return (ssb / (k - 1)) / (ssw / (N - k))
+
+    def clusters(self, stat):
+        """
+        Return the cluster number of every cell of one statistic map (-1 outside the clusters)
+        and the mass (sum of absolute statistics) of every cluster
+        """
+        labels = np.full(len(stat), -1)
+        masses = []
+        for sign in ((1, -1) if self.two_sided else (1,)):
+            idx = np.flatnonzero(sign * np.nan_to_num(stat) > self.threshold)
+            if not len(idx):
+                continue
+            n, lab = scipy.sparse.csgraph.connected_components(self.graph[idx][:, idx], directed=False)
+            labels[idx] = lab + len(masses)
+            masses.extend(np.bincount(lab, weights=np.abs(stat[idx]), minlength=n))
+        return labels, np.array(masses)
+
+    def null(self, stats):
+        """
+        Return the maximum statistic, or the maximum cluster mass, of every permutation of a batch
+        """
+        if self.correction == "cluster":
+            return np.array([max(self.clusters(s)[1], default=0.0) for s in stats])
+        stats = np.nan_to_num(np.abs(stats) if self.two_sided else stats, nan=-np.inf)
+        return stats.max(axis=1)
+
+    def null_batch(self, seed, n):
+        return self.null(self.statistic(self.permutations(np.random.default_rng(seed), n)))
+
+    def run(self, n_permutations=5000, seed=0, jobs=1, batch=500):
+        """
+        Run the test
+        :param n_permutations: number of random permutations
+        :param seed: seed of the permutations. Every batch has its own seed derived from it, so
+                     results do not depend on the number of jobs
+        :param jobs: number of processes computing batches of permutations
+        :param batch: permutations computed at a time
+        :returns: observed statistic and corrected p-value of every cell, as rows x columns arrays
+        """
+        sizes = [min(batch, n_permutations - i) for i in range(0, n_permutations, batch)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        if jobs > 1 and len(sizes) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                null = list(executor.map(_null_batch, [self] * len(sizes), seeds, sizes))
+        else:
+            null = [self.null_batch(s, n) for s, n in zip(seeds, sizes)]
+        null = np.sort(np.concatenate(null))
+
+        stat = self.observed()
+        if self.correction == "cluster":
+            labels, masses = self.clusters(stat)
+            cluster_p = (1 + len(null) - np.searchsorted(null, masses, side="left")) / (len(null) + 1.0)
+            p = np.where(labels >= 0, np.append(cluster_p, 1.0)[labels], 1.0)
+        else:
+            obs = np.abs(stat) if self.two_sided else stat
+            p = (1 + len(null) - np.searchsorted(null, obs, side="left")) / (len(null) + 1.0)
+        p = np.where(np.isnan(stat), np.nan, p)
+        return stat.reshape(self.shape), p.reshape(self.shape)
+
+
+def _null_batch(test, seed, n):
+    return test.null_batch(seed, n)
+
+
+@instrument.timed
+def compare_groups(tables, groups, subjects=None, design="independent", setup=None,
+                   names=STAT_TABLES, n_permutations=5000, correction="max", cluster_alpha=0.05,
+                   seed=0, jobs=1):
+    """
+    Compare groups of recordings on every cell of their result tables, see `PermutationTest`.
+    Groups are taken in order of appearance, so a t statistic is the second group minus the first,
+    or the second condition minus the first in a paired design.
+    :param tables: list with the result tables of every recording
+    :param groups: group (or condition) of every recording
+    :param subjects: subject of every recording, pairs the conditions of the `paired` design
+    :param design: one of `DESIGNS`
+    :param setup: channel setup, needed for the `cluster` correction of channel tables
+    :param names: tables compared
+    :returns: dictionary with the statistic `<name>_stat` and p-value `<name>_p` tables,
+              and the name of the statistic as `stat_name`
+    """
+    levels = list(dict.fromkeys(groups))
+    codes = np.array([levels.index(g) for g in groups])
+    if design == "paired":
+        if len(levels) != 2 or subjects is None:
+            raise ValueError("ERROR: a paired design needs two conditions and the subject of every recording")
+        first = {s: i for s, c, i in zip(subjects, codes, range(len(codes))) if c == 0}
+        second = {s: i for s, c, i in zip(subjects, codes, range(len(codes))) if c == 1}
+        paired = [(first[s], second[s]) for s in first if s in second]
+        if len(paired) < 2:
+            raise ValueError("ERROR: a paired design needs at least two subjects with both conditions")
+
+    results = {}
+    for name in names:
+        with instrument.stage("permutation test", table=name):
+            values, index, columns = stack_tables([t[name] for t in tables])
+            if design == "paired":
+                values = np.stack([values[j] - values[i] for i, j in paired])
+            adjacency = None
+            if correction == "cluster":
+                adjacency = pair_adjacency(columns) if isinstance(columns, pd.MultiIndex) else \
+                    channel_adjacency(setup).reindex(index=columns, columns=columns).fillna(0).values
+            test = PermutationTest(values, codes, design, correction, adjacency, cluster_alpha)
+            stat, p = test.run(n_permutations, seed, jobs)
+        results[name + "_stat"] = pd.DataFrame(stat, index=index, columns=columns)
+        results[name + "_p"] = pd.DataFrame(p, index=index, columns=columns)
+        results["stat_name"] = test.stat_name
+    return results
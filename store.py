@@ -0,0 +1,221 @@
+"""
+Columnar store with the result tables of every recording of a run.
+Tables are kept in long format, one value per row labelled by subject, band, frequency, time and
+channels, in a parquet dataset partitioned by metric (the table name). Every subject is written
+to its own file as soon as it is analyzed, so workers can write concurrently and a run can be
+extended later, and queries only read the metrics and row groups they need.
+
+    python store.py Reports/results --query metric=rel_df band=alpha1 channel=Pz
+    python store.py Reports/results --csv Reports/csv
+"""
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# store columns of the row and column labels of every table
+LAYOUTS = {"psd_df": (["freq"], ["channel"]),
+           "peaks_df": (["band"], ["channel", "stat"]),
+           "abs_df": (["band"], ["channel"]),
+           "rel_df": (["band"], ["channel"]),
+           "cor_df": (["ch1"], ["ch2"]),
+           "coh_df": (["band"], ["ch1", "ch2"]),
+           "pdif_df": (["band"], ["ch1", "ch2"]),
+           "plv_df": (["band"], ["ch1", "ch2"]),
+           "wpli_df": (["band"], ["ch1", "ch2"]),
+           "amp_cor_df": (["band"], ["ch1", "ch2"]),
+           "abs_time_df": (["time"], ["band", "channel"]),
+           "rel_time_df": (["time"], ["band", "channel"]),
+           "peak_time_df": (["time"], ["band", "channel"])}
+
+SCHEMA = pa.schema([("subject", pa.string()),
+                    ("band", pa.string()),
+                    ("freq", pa.float64()),
+                    ("time", pa.float64()),
+                    ("channel", pa.string()),
+                    ("ch1", pa.string()),
+                    ("ch2", pa.string()),
+                    ("stat", pa.string()),
+                    ("value", pa.float64())])
+
+PARTITIONING = ds.partitioning(pa.schema([("metric", pa.string())]), flavor="hive")
+
+
+def to_long(df, subject, layout):
+    """
+    Return the columns of a table in long format, see `SCHEMA`. Cells are in row major order.
+    :param df: result table
+    :param subject: name of the recording
+    :param layout: store columns of the index and column levels, see `LAYOUTS`
+    """
+    rows, cols = layout
+    n_rows, n_cols = df.shape
+    columns = {name: None for name in SCHEMA.names}
+    for field, level in zip(rows, range(df.index.nlevels)):
+        columns[field] = np.repeat(np.asarray(df.index.get_level_values(level)), n_cols)
+    for field, level in zip(cols, range(df.columns.nlevels)):
+        columns[field] = np.tile(np.asarray(df.columns.get_level_values(level)), n_rows)
+    columns["subject"] = np.full(n_rows * n_cols, subject)
+    columns["value"] = np.asarray(df.values, dtype=np.float64).ravel()
+    arrays = []
+    for field in SCHEMA:
+        values = columns[field.name]
+        if values is None:
+            arrays.append(pa.nulls(n_rows * n_cols, field.type))
+        else:
+            if pa.types.is_string(field.type):
+                values = values.astype(str)
+            arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+
+class ResultStore(object):
+    """
+    Parquet dataset with the result tables of a run, see the module documentation.
+    :param folder: folder of the dataset, created if needed
+    :param compression: parquet compression codec
+    """
+
+    def __init__(self, folder, compression="zstd"):
+        self.folder = folder
+        self.compression = compression
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def _path(self, metric, subject):
+        return os.path.join(self.folder, "metric=" + metric, subject + ".parquet")
+
+    def write(self, subject, tables):
+        """
+        Store the tables of a recording, replacing the ones stored before for `subject`.
+        Tables without a layout in `LAYOUTS` are not stored.
+        :param subject: name of the recording
+        :param tables: dictionary of result tables
+        """
+        for metric, df in tables.items():
+            if metric not in LAYOUTS or not isinstance(df, pd.DataFrame):
+                continue
+            table = to_long(df, subject, LAYOUTS[metric])
+            # names of the index and column levels, to rebuild the table, see `table`
+            table = table.replace_schema_metadata({"reportes": json.dumps({
+                "index": list(df.index.names), "columns": list(df.columns.names),
+                "shape": list(df.shape)})})
+            path = self._path(metric, subject)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # hidden until complete, the dataset skips files starting with a dot
+            temp = os.path.join(os.path.dirname(path), "." + subject + "." + str(os.getpid()) + ".tmp")
+            pq.write_table(table, temp, compression=self.compression)
+            os.replace(temp, path)
+
+    def dataset(self):
+        # only files being written are hidden, subjects may start with an underscore
+        return ds.dataset(self.folder, schema=SCHEMA.append(pa.field("metric", pa.string())),
+                          format="parquet", partitioning=PARTITIONING, ignore_prefixes=["."])
+
+    def query(self, columns=None, **filters):
+        """
+        Return the stored values matching every filter as a DataFrame, without the columns that
+        do not apply to them, e.g. `query(metric="rel_df", band="alpha1", channel="Pz")`.
+        Only the partitions of the filtered metrics and the row groups that can match are read.
+        :param columns: columns returned, all by default
+        :param filters: value, or list of values, of store columns (see `SCHEMA`) or `metric`
+        """
+        expression = None
+        for field, value in filters.items():
+            if isinstance(value, (list, tuple, set)):
+                condition = ds.field(field).isin(list(value))
+            else:
+                condition = ds.field(field) == value
+            expression = condition if expression is None else expression & condition
+        df = self.dataset().to_table(columns=columns, filter=expression).to_pandas()
+        return df.dropna(axis=1, how="all")
+
+    def metrics(self):
+        return sorted(name[len("metric="):] for name in os.listdir(self.folder) if name.startswith("metric="))
+
+    def subjects(self, metric=None):
+        """
+        Return the subjects stored, for every metric or only for `metric`
+        """
+        subjects = set()
+        for m in ([metric] if metric else self.metrics()):
+            folder = os.path.join(self.folder, "metric=" + m)
+            subjects.update(os.path.splitext(name)[0] for name in os.listdir(folder) if name.endswith(".parquet"))
+        return sorted(subjects)
+
+    def table(self, subject, metric):
+        """
+        Return a stored table in its original wide format
+        """
+        path = self._path(metric, subject)
+        if not os.path.isfile(path):
+            raise IOError("ERROR: no " + metric + " stored for " + subject)
+        table = pq.read_table(path)
+        info = json.loads(table.schema.metadata[b"reportes"])
+        n_rows, n_cols = info["shape"]
+        rows, cols = LAYOUTS[metric]
+        values = table.column("value").to_numpy().reshape(n_rows, n_cols)
+        index = [table.column(f).to_numpy(zero_copy_only=False)[::n_cols] for f in rows]
+        columns = [table.column(f).to_numpy(zero_copy_only=False)[:n_cols] for f in cols]
+        index = pd.MultiIndex.from_arrays(index) if len(index) > 1 else pd.Index(index[0])
+        columns = pd.MultiIndex.from_arrays(columns) if len(columns) > 1 else pd.Index(columns[0])
+        index.names = info["index"]
+        columns.names = info["columns"]
+        return pd.DataFrame(values, index=index, columns=columns)
+
+    def export_csv(self, folder, subjects=None, metrics=None):
+        """
+        Write the stored tables as `<subject>_<metric>.csv` files in `folder`
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        for metric in metrics or self.metrics():
+            for subject in subjects or self.subjects(metric):
+                self.table(subject, metric).to_csv(os.path.join(folder, subject + "_" + metric + ".csv"))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="Reportes store",
+                                     description="Query the result store of a run.",
+                                     add_help=True)
+    parser.add_argument("store",
+                        help="Folder of the result store")
+    parser.add_argument("--query", "-q",
+                        help="Filters as column=value, e.g. metric=rel_df band=alpha1 channel=Pz. "
+                             "Values separated by commas match any of them",
+                        nargs="*")
+    parser.add_argument("--csv",
+                        help="Export the stored tables as csv files to this folder")
+    parser.add_argument("--output", "-o",
+                        help="Write the query result to this csv file instead of printing it")
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    results = ResultStore(args.store)
+    if args.csv:
+        results.export_csv(args.csv)
+    if args.query is not None:
+        filters = {}
+        for item in args.query:
+            if "=" not in item:
+                raise ValueError("ERROR: filters are column=value, got " + item)
+            field, value = item.split("=", 1)
+            values = [float(v) if field in ("freq", "time") else v for v in value.split(",")]
+            filters[field] = values if len(values) > 1 else values[0]
+        df = results.query(**filters)
+        if args.output:
+            df.to_csv(args.output, index=False)
+        else:
+            df.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()